@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+'''End-to-end enve benchmark against stand-in flatpak and flatpak-spawn executables.
+
+Fake flatpak and flatpak-spawn executables are put on PATH, answering list, info, install, update, remove and run from a
+JSON state file after a configurable latency. For synthetic configs of 1 to 500 extensions, each with its own
+variables, it times load_enve_config with a cold and a warm cache, add_variables, and run_cmd up to the point the
+command would be run, both directly and from within an ENVE shell, which spawns a nested ENVE through flatpak run,
+along with the pty2 relay throughput. The results are printed as JSON so they can be compared
+between revisions:
+
+    python3 benchmarks/bench_e2e.py --latency 50 --repeat 3 > e2e.json
+'''
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ENVE_SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Number of extensions in each synthetic config
+EXTENSION_COUNTS = [1, 10, 100, 500]
+
+FLATPAK_RUNTIME = 'org.freedesktop.Sdk/x86_64/20.08'
+FLATPAK_EXTENSION_REF = 'org.freedesktop.Sdk.Extension.%s/x86_64/20.08'
+
+FAKE_FLATPAK_SPAWN = r'''#!%(python)s
+import os, sys
+args = sys.argv[1:]
+while args and args[0].startswith('--'):
+    arg = args.pop(0)
+    if arg.startswith('--env='):
+        name, value = arg[len('--env='):].split('=', 1)
+        os.environ[name] = value
+os.execvp(args[0], args)
+'''
+
+FAKE_FLATPAK = r'''#!%(python)s
+import os, sys, json, time
+time.sleep(float(os.environ.get('ENVE_BENCH_LATENCY', '0')))
+state_path = os.environ['ENVE_BENCH_STATE']
+with open(state_path) as state_file:
+    state = json.load(state_file)
+args = [arg for arg in sys.argv[1:] if not arg.startswith(('--user', '--system', '--installation'))]
+refs = [arg for arg in args[1:] if arg.count('/') == 2]
+
+def save():
+    with open(state_path, 'w') as state_file:
+        json.dump(state, state_file)
+
+if args[0] == 'list':
+    for ref, installed in state['installed'].items():
+        print('%%s\t%%s\t%%s' %% (ref, installed['origin'], installed['commit']))
+elif args[0] == 'install':
+    remotes = [arg for arg in args[1:] if not arg.startswith('-') and arg.count('/') != 2]
+    for ref in refs:
+        state['installed'][ref] = {'origin': remotes[0] if remotes else 'flathub', 'commit': '0' * 64}
+    save()
+elif args[0] == 'update':
+    for ref in refs:
+        state['installed'][ref]['commit'] = args[args.index('--commit') + 1] if '--commit' in args else '0' * 64
+    save()
+elif args[0] == 'remove':
+    for ref in refs:
+        state['installed'].pop(ref, None)
+    save()
+elif args[0] == 'info' and args[-1] == state['app_id']:
+    print('[Application]\nname=%%s\ncommand=enve\nsdk=%%s\n' %% (state['app_id'], state['runtime']))
+elif args[0] == 'run':
+    run_args = args[1:]
+    environ = {name: os.environ[name] for name in ('PATH', 'HOME', 'XDG_CACHE_HOME', 'ENVE_BENCH_LATENCY',
+                                                     'ENVE_BENCH_STATE', 'ENVE_BENCH_START', 'ENVE_BENCH_STOP_AT_RUN') \
+               if name in os.environ}
+    environ['FLATPAK_ID'] = state['app_id']
+    while run_args[0].startswith('--'):
+        arg = run_args.pop(0)
+        if arg.startswith('--env='):
+            name, value = arg[len('--env='):].split('=', 1)
+            environ[name] = value
+    # flatpak run --command=X APP ARGS runs X ARGS, where X is the runner here
+    os.execve(sys.executable, [sys.executable, state['runner']] + run_args[1:], environ)
+else:
+    sys.exit(1)
+'''
+
+# Runs enve from the source tree, with the config files taken from the source tree instead of the SDK extension
+ENVE_RUNNER = r'''import os, sys, time
+# A nested ENVE spawned through flatpak run reports the time since the outermost one started
+os.environ.setdefault('ENVE_BENCH_START', str(time.time()))
+sys.path.insert(0, %(src)r)
+import enve
+enve.ENVE_LIBSONNET_PATH = os.path.join(%(src)r, 'enve.libsonnet')
+enve.ENVE_BASHRC_PATH = os.path.join(%(src)r, 'enve_bashrc')
+enve.ENVE_RUN_CMD = (%(shell)r, '--noprofile', '-c')
+enve.ENVE_RUN_INTERACTIVE_CMD = (%(shell)r, '--noprofile', '-i', '-c')
+if os.environ.get('ENVE_BENCH_STOP_AT_RUN'):
+    # Stop the moment the command would be run, reporting the time taken to get there
+    def run(cmd, *args, **kwargs):
+        if tuple(cmd[:len(enve.ENVE_RUN_CMD)]) in [enve.ENVE_RUN_CMD, enve.ENVE_RUN_INTERACTIVE_CMD]:
+            print(json.dumps({'ms': (time.time() - float(os.environ['ENVE_BENCH_START'])) * 1000}), flush=True)
+            os._exit(0)
+        return subprocess_run(cmd, *args, **kwargs)
+    import json, subprocess
+    subprocess_run = subprocess.run
+    enve.subprocess.run = run
+enve.cli(prog_name='enve')
+'''
+
+# Times load_enve_config and add_variables in-process
+ENVE_LOAD_WORKER = r'''import os, sys, time, json
+sys.path.insert(0, %(src)r)
+import enve
+enve.ENVE_LIBSONNET_PATH = os.path.join(%(src)r, 'enve.libsonnet')
+enve.ENVE_BASHRC_PATH = os.path.join(%(src)r, 'enve_bashrc')
+enve_options = enve.enve_default_options()
+enve_options['use-config'].update_value(%(config)r, was_passed=True)
+start_time = time.perf_counter()
+enve.load_enve_config(enve_options)
+load_ms = (time.perf_counter() - start_time) * 1000
+
+enve_json, _ = enve.load_enve_json(%(config)r)
+enve_vars, enve_delimiters = {}, {}
+start_time = time.perf_counter()
+for flatpak_extension in reversed(enve_json['extensions']):
+    enve.add_variables(enve_vars, enve_delimiters, flatpak_extension['variables'], flatpak_extension['id_alias'],
+                       flatpak_extension['path'])
+enve.join_variables(enve_vars, enve_delimiters)
+print(json.dumps({'load_ms': load_ms, 'add_variables_ms': (time.perf_counter() - start_time) * 1000}))
+'''
+
+def make_config(config_path: str, extension_count: int) -> list:
+    '''Write a synthetic config with extension_count extensions, returning their flatpak refs.'''
+
+    extensions = []
+    for index in range(extension_count):
+        extensions.append("Enve.NewExtension('Bench%d', variables=[Enve.NewVariable('BIN', 'bin', exports='PATH'), "
+                          "Enve.NewVariable('LIB', 'lib', exports='LD_LIBRARY_PATH'), "
+                          "Enve.NewVariable('SHARE', ['share', 'share/%d']), "
+                          "Enve.NewVariable('FLAGS', '-O2', values_are_paths=false, delimiter=' ')])" % (index, index))
+
+    with open(config_path, 'w') as config_file:
+        config_file.write("local Enve = import 'enve.libsonnet';\n{\n  Enve: Enve {\n"
+                          "    id+: Enve.NewId('Bench', '%d'),\n"
+                          "    variables+: [Enve.NewVariable('TOOLS', 'tools', exports='PATH')],\n"
+                          "    extensions+: [\n      %s\n    ],\n  },\n}\n" % (extension_count,
+                                                                                ',\n      '.join(extensions)))
+
+    return [FLATPAK_EXTENSION_REF % 'enve'] + [FLATPAK_EXTENSION_REF % ('Bench%d' % index) \
+                                               for index in range(extension_count)]
+
+def write_state(state_path: str, runner_path: str, refs: list) -> None:
+    '''Every extension is already installed, so the verification only lists the installation.'''
+
+    with open(state_path, 'w') as state_file:
+        json.dump({'app_id': 'dev.enve.sh', 'runtime': FLATPAK_RUNTIME, 'runner': runner_path,
+                   'installed': {ref: {'origin': 'flathub', 'commit': '0' * 64} for ref in refs}}, state_file)
+
+def run_worker(args: list, environ: dict, cwd: str) -> dict:
+    completed_output = subprocess.run(args, env=environ, cwd=cwd, capture_output=True, text=True)
+    if completed_output.returncode != 0 or not completed_output.stdout.strip():
+        raise RuntimeError('Benchmark worker failed:\n%s' % completed_output.stderr)
+
+    return json.loads(completed_output.stdout.splitlines()[-1])
+
+def bench_config(work_path: str, environ: dict, runner_path: str, extension_count: int, repeat: int) -> dict:
+    config_path = os.path.join(work_path, 'enve.jsonnet')
+    state_path = environ['ENVE_BENCH_STATE']
+    refs = make_config(config_path, extension_count)
+    load_worker = [sys.executable, '-c', ENVE_LOAD_WORKER % {'src': ENVE_SRC_PATH, 'config': config_path}]
+    run_args = [sys.executable, runner_path, '--ENVE', 'use-config', config_path, '--ENVE', 'use-interactive', 'f',
+                'true']
+
+    runs = []
+    for _ in range(repeat):
+        write_state(state_path, runner_path, refs)
+        shutil.rmtree(environ['XDG_CACHE_HOME'], ignore_errors=True)
+        cold = run_worker(load_worker, environ, work_path)
+        warm = run_worker(load_worker, environ, work_path)
+        run = run_worker(run_args, dict(environ, ENVE_BENCH_STOP_AT_RUN='1'), work_path)
+        # From within an ENVE shell, the command is run by a nested ENVE spawned through flatpak run
+        nested_run = run_worker(run_args, dict(environ, ENVE_BENCH_STOP_AT_RUN='1', ENVE_ID='Bench'), work_path)
+        runs.append({'load_enve_config_cold_ms': cold['load_ms'], 'load_enve_config_warm_ms': warm['load_ms'],
+                     'add_variables_ms': warm['add_variables_ms'], 'run_cmd_ms': run['ms'],
+                     'run_cmd_nested_ms': nested_run['ms']})
+
+    # Report the fastest run of each measurement
+    return dict((name, min(run[name] for run in runs)) for name in runs[0])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds each fake flatpak call takes.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per config, the fastest run is reported.')
+    parser.add_argument('--pty2-size', type=int, default=16, help='MiB relayed through pty2, 0 to skip.')
+    parser.add_argument('extension_counts', nargs='*', type=int, default=EXTENSION_COUNTS,
+                        help='Number of extensions in each config: %s.' % ', '.join(map(str, EXTENSION_COUNTS)))
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='enve-bench-')
+    try:
+        bin_path = os.path.join(work_path, 'bin')
+        os.makedirs(bin_path)
+        for name, script in [('flatpak', FAKE_FLATPAK), ('flatpak-spawn', FAKE_FLATPAK_SPAWN)]:
+            with open(os.path.join(bin_path, name), 'w') as script_file:
+                script_file.write(script % {'python': sys.executable})
+            os.chmod(os.path.join(bin_path, name), 0o755)
+
+        # The sandbox shell is bash, which the host /bin/sh may not be
+        runner_path = os.path.join(work_path, 'enve_runner.py')
+        with open(runner_path, 'w') as runner_file:
+            runner_file.write(ENVE_RUNNER % {'src': ENVE_SRC_PATH, 'shell': shutil.which('bash') or '/bin/sh'})
+
+        environ = {'PATH': bin_path + os.pathsep + os.environ.get('PATH', ''),
+                   'HOME': work_path,
+                   'XDG_CACHE_HOME': os.path.join(work_path, 'cache'),
+                   'FLATPAK_ID': 'dev.enve.sh',
+                   'ENVE_BENCH_LATENCY': str(args.latency / 1000),
+                   'ENVE_BENCH_STATE': os.path.join(work_path, 'state.json')}
+
+        results = {}
+        for extension_count in args.extension_counts:
+            results[extension_count] = bench_config(work_path, environ, runner_path, extension_count, args.repeat)
+
+        pty2_results = {}
+        if args.pty2_size:
+            sys.path.insert(0, BENCHMARKS_PATH)
+            import bench_pty2
+
+            for scenario in bench_pty2.SCENARIOS:
+                pty2_results[scenario] = max((bench_pty2.relay(scenario, args.pty2_size << 20) \
+                                              for _ in range(args.repeat)), key=lambda run: run['mb_per_second'])
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    json.dump({'benchmark': 'e2e', 'python': sys.executable, 'latency_ms': args.latency, 'results': results,
+               'pty2': pty2_results}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+'''Track the import cost of the common enve invocations using python -X importtime.
+
+Each scenario imports enve plus the modules its code path imports lazily, and the totals are printed as JSON in
+microseconds so they can be compared between revisions:
+
+    python3 benchmarks/bench_importtime.py --repeat 10 > importtime.json
+'''
+
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+ENVE_SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules imported by each of the common code paths
+SCENARIOS = {
+    # The interpreter startup alone, for reference
+    'baseline': [],
+    # Every invocation, including when the current config SHA already matches or the command is non-interactive
+    'startup': ['enve'],
+    # A config cache miss evaluates the Jsonnet config
+    'evaluate': ['enve', '_jsonnet'],
+    # Spawning a new ENVE shell loads the flatpak app metadata
+    'spawn': ['enve', 'configparser'],
+    # An interactive command, possibly through the PTY fallback, with the MOTD and debug logging
+    'interactive': ['enve', 'psutil', 'pty2', 'enve_motd', 'pprint'],
+}
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s+)(\S+)')
+
+def importtime(python: str, modules: list) -> dict:
+    '''Import the modules in a fresh interpreter, returning the total self time of every module imported.'''
+
+    completed_output = subprocess.run([python, '-X', 'importtime', '-c', '; '.join(['pass'] + ['import %s' % module \
+                                                                                                 for module in modules])],
+                                      cwd=ENVE_SRC_PATH, env=dict(os.environ, PYTHONPATH=ENVE_SRC_PATH),
+                                      capture_output=True, text=True)
+    if completed_output.returncode != 0:
+        raise RuntimeError('Importing %s failed:\n%s' % (', '.join(modules), completed_output.stderr))
+
+    import_times = [IMPORTTIME_RE.match(line) for line in completed_output.stderr.splitlines()]
+    import_times = [import_time for import_time in import_times if import_time]
+
+    return {'total_us': sum(int(import_time.group(1)) for import_time in import_times),
+            'modules': len(import_times)}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to measure.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per scenario, the fastest run is reported.')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help='Scenarios to measure: %s.' % ', '.join(SCENARIOS))
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario "%s"' % scenario)
+
+    results = {}
+    for scenario in args.scenarios:
+        runs = [importtime(args.python, SCENARIOS[scenario]) for _ in range(args.repeat)]
+        results[scenario] = min(runs, key=lambda run: run['total_us'])
+
+    json.dump({'benchmark': 'importtime', 'python': args.python, 'results': results}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
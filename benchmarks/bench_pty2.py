@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+'''Measure the throughput of the pty2.wspawn relay in MB/s.
+
+A child process runs wspawn on a command writing a fixed number of bytes, with a pseudo-terminal as its standard input
+and either a pipe or a pseudo-terminal as its standard output, which this process drains. The results are printed as
+JSON so they can be compared between revisions:
+
+    python3 benchmarks/bench_pty2.py --size 256 --repeat 5 > pty2.json
+'''
+
+import os
+import pty
+import sys
+import json
+import time
+import argparse
+
+ENVE_SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The standard output of the wspawn process for each scenario
+SCENARIOS = ['pipe', 'pty']
+
+def relay(scenario: str, size: int) -> dict:
+    '''Relay size bytes through wspawn, returning the elapsed time and the CPU time of the wspawn process.'''
+
+    # The relay resizes the child PTY from its standard input, so that has to be a terminal as well
+    stdin_master_fd, stdin_slave_fd = pty.openpty()
+    if scenario == 'pipe':
+        out_read_fd, out_write_fd = os.pipe()
+    else:
+        out_read_fd, out_write_fd = pty.openpty()
+
+    start_time = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.setsid()
+        os.dup2(stdin_slave_fd, pty.STDIN_FILENO)
+        os.dup2(out_write_fd, pty.STDOUT_FILENO)
+        for fd in (stdin_master_fd, stdin_slave_fd, out_read_fd, out_write_fd):
+            os.close(fd)
+        sys.path.insert(0, ENVE_SRC_PATH)
+        import pty2
+        try:
+            pty2.wspawn(['head', '-c', str(size), '/dev/zero'])
+        finally:
+            os._exit(0)
+
+    os.close(stdin_slave_fd)
+    os.close(out_write_fd)
+    relayed = 0
+    while True:
+        try:
+            data = os.read(out_read_fd, 1 << 20)
+        except OSError:  # EIO once the last writer of a PTY closes
+            break
+        if not data:
+            break
+        relayed += len(data)
+    _, _, rusage = os.wait4(pid, 0)
+    elapsed = time.perf_counter() - start_time
+    os.close(out_read_fd)
+    os.close(stdin_master_fd)
+
+    return {'bytes': relayed, 'seconds': elapsed, 'cpu_seconds': rusage.ru_utime + rusage.ru_stime,
+            'mb_per_second': relayed / elapsed / (1 << 20)}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64, help='MiB written by the child per run.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scenario, the fastest run is reported.')
+    parser.add_argument('scenarios', nargs='*', default=SCENARIOS,
+                        help='Standard output of the relay to measure: %s.' % ', '.join(SCENARIOS))
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('unknown scenario "%s"' % scenario)
+
+    results = {}
+    for scenario in args.scenarios:
+        runs = [relay(scenario, args.size << 20) for _ in range(args.repeat)]
+        results[scenario] = max(runs, key=lambda run: run['mb_per_second'])
+
+    json.dump({'benchmark': 'pty2', 'python': sys.executable, 'size_mib': args.size, 'results': results}, sys.stdout,
+              indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+'''Measure building and merging the ENVE variables for synthetic configs with many extensions.
+
+Each extension contributes delimited variables exported to PATH, LD_LIBRARY_PATH, PKG_CONFIG_PATH and a few private
+variables, the same as the extensions in enve.libsonnet. The time to add every variable, join them and merge in the
+inherited environment is printed as JSON in milliseconds so it can be compared between revisions:
+
+    python3 benchmarks/bench_variables.py --repeat 10 > variables.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+
+ENVE_SRC_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ENVE_SRC_PATH)
+
+import enve
+
+# Number of extensions in each synthetic config
+EXTENSION_COUNTS = [1, 10, 100, 500]
+
+# The variables each extension contributes, as (name, exports, delimiter, sub-directory)
+EXTENSION_VARIABLES = [('BIN', ['PATH'], ':', 'bin'),
+                       ('LIB', ['LD_LIBRARY_PATH'], ':', 'lib'),
+                       ('PKG_CONFIG', ['PKG_CONFIG_PATH'], ':', 'lib/pkgconfig'),
+                       ('SHARE', [''], ':', 'share'),
+                       ('FLAGS', [''], ' ', '-I/include')]
+
+def make_variable(name: str, exports: list, delimiter: str, values: list) -> dict:
+    return {'name': name, 'exports': exports, 'delimiter': delimiter, 'delimit_first': False,
+            'values_are_paths': False, 'values': values}
+
+def make_extensions(extension_count: int) -> list:
+    '''Synthetic extensions, the same layout as an extension definition evaluated from enve.libsonnet.'''
+
+    return [{'id_alias': 'EXT%d' % index, 'path': '/usr/lib/sdk/ext%d' % index,
+             'variables': [make_variable(name, exports, delimiter,
+                                         # Every extension also adds a path shared with the others
+                                         ['/usr/lib/sdk/ext%d/%s' % (index, sub_path), '/usr/lib/sdk/shared/%s' % sub_path])
+                           for name, exports, delimiter, sub_path in EXTENSION_VARIABLES]}
+            for index in range(extension_count)]
+
+def build(extensions: list, environ: dict) -> dict:
+    '''Build, join and merge the variables the same as resolve_enve_variables and export_variables.'''
+
+    enve_vars = {}
+    enve_delimiters = {}
+    for extension in extensions:
+        enve.add_variables(enve_vars, enve_delimiters, extension['variables'], extension['id_alias'])
+
+    return enve.merge_environ_variables(enve.join_variables(enve_vars, enve_delimiters), enve_delimiters, environ)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per config, the fastest run is reported.')
+    parser.add_argument('extension_counts', nargs='*', type=int, default=EXTENSION_COUNTS,
+                        help='Number of extensions in each config: %s.' % ', '.join(map(str, EXTENSION_COUNTS)))
+    args = parser.parse_args()
+
+    environ = {'PATH': ':'.join('/opt/tool%d/bin' % index for index in range(50)) + ':/usr/bin:/bin',
+               'LD_LIBRARY_PATH': '/opt/lib', 'PKG_CONFIG_PATH': '/usr/lib/pkgconfig'}
+
+    results = {}
+    for extension_count in args.extension_counts:
+        runs = []
+        for _ in range(args.repeat):
+            # add_variables resolves the values in place, so each run gets its own copy of the config
+            extensions = make_extensions(extension_count)
+            start_time = time.perf_counter()
+            enve_vars = build(extensions, environ)
+            runs.append((time.perf_counter() - start_time) * 1000)
+
+        results[extension_count] = {'variables': len(extensions) * len(EXTENSION_VARIABLES),
+                                    'path_length': len(enve_vars['PATH']), 'ms': min(runs)}
+
+    json.dump({'benchmark': 'variables', 'python': sys.executable, 'results': results}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -18,32 +18,53 @@ ENVE_BASHRC_PATH = os.path.join(ENVE_ETC_PATH, 'enve_bashrc')
 ENVE_PY_PATH = os.path.join(ENVE_SRC_PATH, 'enve.py')
 ENVE_RUN_CMD = ('/bin/sh', '--noprofile', '-c')
 ENVE_RUN_INTERACTIVE_CMD = ('/bin/sh', '--noprofile', '-i', '-c')
+ENVE_SNAPSHOT_MAX_SIZE = 64 * 1024
+ENVE_FLATPAK_USER_INSTALLATION_PATH = os.path.expanduser('~/.local/share/flatpak')
+ENVE_FLATPAK_SYSTEM_INSTALLATION_PATH = '/var/lib/flatpak'
+ENVE_FLATPAK_INSTALLATIONS_CONF_PATH = '/etc/flatpak/installations.d'
+# Describes the running sandbox, including the commit of every extension mounted in it
+ENVE_FLATPAK_INFO_PATH = '/.flatpak-info'
+# Where the host filesystem is mounted if it isn't shared at the same paths
+ENVE_HOST_ROOT_PATH = '/run/host'
 
 import site
 site.addsitedir(os.path.join(ENVE_LIB_PATH, 'python3.8/site-packages'))
 
+# Only the modules needed on every code path are imported here. The heavier modules (_jsonnet, psutil, pty2, enve_motd,
+# configparser and pprint) are imported by the code paths that use them, so invocations that never reach those paths
+# don't pay for them at startup.
 import re
-import enve_motd
-import pty2
 import collections
 import click
 import json
-import _jsonnet
+import hashlib
+import enve_cache
+import enve_profile
 import subprocess
 import logging
-import configparser
-import pprint
 import textwrap
-import psutil
 import copy
+import base64
+import zlib
+
+class DebugFormat:
+    '''Pretty formats an object for the debug log, indented under the log message. The formatting (and the pprint
+    import) is deferred until the log record is emitted, so it costs nothing when debug logging is off.'''
+
+    def __init__(self, debug_obj):
+        self._debug_obj = debug_obj
+
+    def __str__(self):
+        import pprint
+
+        return textwrap.indent(pprint.pformat(self._debug_obj), '  ')
 
 def add_enve_prompt_variable(enve_vars: dict, enve_options: dict) -> None:
     '''Add doc...'''
 
     heavy_seperator, light_seperator = ['▌','┆'] if enve_options['use-basic-prompt'].value() else ['', '']
-    enve_prompt = r'$(status="$(sha256sum $ENVE_CURRENT_CONFIG | cut -d " " -f 1)"; '
-    enve_prompt += r'[[ "$ENVE_CURRENT_CONFIG_SHA_256" = "$status" ]] || '
-    enve_prompt += r'echo "\[\e[30;41m\]Modified\[\e[31;42m\]%s")' % heavy_seperator
+    # ENVE_CONFIG_MODIFIED is set by the enve_bashrc prompt command when the config files have changed
+    enve_prompt = r'${ENVE_CONFIG_MODIFIED:+\[\e[30;41m\]Modified\[\e[31;42m\]%s}' % heavy_seperator
     enve_prompt += r'\[\e[30;42m\]📦$ENVE_ID${ENVE_ID_VER:+ ${ENVE_ID_VER}}'
 
     if os.environ['FLATPAK_ID'] != ENVE_FLATPAK_APP_ID:
@@ -65,16 +86,209 @@ def add_enve_id_version_variables(enve_vars: dict, enve_id: dict) -> None:
     enve_vars['ENVE_ID'] = enve_id['name']
     enve_vars['ENVE_ID_VER'] = enve_id['version']
 
-def add_enve_current_config_variables(enve_vars: dict, enve_options: dict) -> None:
+def get_config_sha_256(config_paths: list) -> str:
+    '''Compute the SHA-256 fingerprint of the ENVE config file and the files it imports, the same as
+    "sha256sum FILE... | sha256sum". Files unchanged since they were last hashed are not read again.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    with enve_profile.span('get_config_sha_256', paths=config_paths):
+        config_sha_256 = enve_cache.files_sha256(config_paths)
+    if config_sha_256 is None:
+        logger.error('Failure computing sha256sum for %s', ', '.join(config_paths))
+        exit(1)
+
+    return config_sha_256
+
+def add_enve_current_config_variables(enve_vars: dict, enve_options: dict, config_imports: list) -> None:
     '''Add doc...'''
 
-    enve_vars['ENVE_CURRENT_CONFIG'] = os.path.abspath(enve_options['use-config'].value())
-    completed_output = subprocess.run(['sha256sum', enve_options['use-config'].value()], capture_output=True, text=True)
-    if completed_output.returncode != 0:
-        logger.error('Failure computing sha256sum for %s', enve_options['use-config'].value())
-        exit(completed_output.returncode)
+    config_paths = [os.path.abspath(enve_options['use-config'].value())] + config_imports
+
+    enve_vars['ENVE_CURRENT_CONFIG'] = config_paths[0]
+    # One path per line, as paths may contain ":"
+    enve_vars['ENVE_CURRENT_CONFIG_FILES'] = '\n'.join(config_paths)
+    enve_vars['ENVE_CURRENT_CONFIG_SHA_256'] = get_config_sha_256(config_paths)
+
+def add_enve_config_stamp_variable(enve_vars: dict) -> None:
+    '''Touch the stamp file the prompt compares the config file mtimes against. The prompt only hashes the config
+    files again once one of them is newer than the stamp, which is shared by the shells loaded from the same content.
+    The stamps are evicted least recently used first along with the prompt cache, touching one on reuse keeps it
+    recent. A shell whose stamp was evicted hashes the config files on its next prompt and writes the stamp again.'''
+
+    prompt_cache = enve_cache.EnveCache('prompt')
+    enve_stamp_path = os.path.join(prompt_cache.path(), enve_vars['ENVE_CURRENT_CONFIG_SHA_256'])
+    try:
+        is_new_stamp = not os.path.exists(enve_stamp_path)
+        os.makedirs(os.path.dirname(enve_stamp_path), exist_ok=True)
+        with open(enve_stamp_path, 'a'):
+            os.utime(enve_stamp_path)
+        if is_new_stamp:
+            prompt_cache.evict()
+    except OSError:
+        pass
+
+    enve_vars['ENVE_CURRENT_CONFIG_STAMP'] = enve_stamp_path
+
+def load_dir_index(cache_name: str, path_dirs: list, is_indexed) -> list:
+    '''Index the files in the directories accepted by is_indexed(path) as (name, path), resolving names found in more
+    than one directory to the first, the same as a PATH search. The index is cached by the directories and the commits
+    of the mounted extensions, and is only valid while no directory has changed since it was indexed.'''
+
+    def get_dir_stat(path_dir: str) -> list:
+        try:
+            dir_stat = os.stat(path_dir)
+            return [dir_stat.st_mtime_ns, dir_stat.st_ino]
+        except OSError:
+            return None
+
+    # The extension directories are read-only checkouts, so a new commit may not change their mtime
+    extension_commits = get_flatpak_extension_commits()
+    index_cache = enve_cache.EnveCache(cache_name)
+    cache_key = '%s\n%s' % (':'.join(path_dirs), ';'.join('%s=%s' % item for item in sorted(extension_commits.items())))
+    cache_entry = index_cache.get(cache_key, is_valid=lambda cache_entry: 'index' in cache_entry and \
+                                  all(get_dir_stat(path_dir) == dir_stat \
+                                      for path_dir, dir_stat in cache_entry['dirs'].items()))
+    if cache_entry:
+        return cache_entry['index']
+
+    # Stat the directories before listing them, so a change while listing invalidates the entry
+    dir_stats = {path_dir: get_dir_stat(path_dir) for path_dir in path_dirs}
+    dir_index = collections.OrderedDict()
+    for path_dir in path_dirs:
+        try:
+            with os.scandir(path_dir) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name not in dir_index and is_indexed(dir_entry.path):
+                        dir_index[dir_entry.name] = dir_entry.path
+        except OSError:
+            pass
+
+    dir_index = list(dir_index.items())
+    index_cache.put(cache_key, {'dirs': dir_stats, 'index': dir_index})
+    return dir_index
+
+def is_executable(path: str) -> bool:
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def is_shared_library(path: str) -> bool:
+    return re.search(r'\.so(\.|$)', os.path.basename(path)) is not None and os.path.isfile(path)
+
+def is_enve_interactive_cmd(enve_options: dict) -> bool:
+    '''Whether the command is run in an interactive shell. Without the use-interactive flag ENVE was run from the host
+    directly, which defaults to interactive. The debug shell is always interactive, and batches never are.'''
+
+    return not enve_options['run-batch'].value() and \
+        ((not enve_options['use-interactive'].was_passed()) or enve_options['use-interactive'].value() or \
+         enve_options['use-debug-shell'].value())
+
+def add_enve_command_table_variable(enve_vars: dict) -> None:
+    '''Write the executables in the PATH directories exported by ENVE as a table of "hash -p" commands, which
+    enve_bashrc sources so the first run of each command skips the PATH search. The inherited PATH comes after the ENVE
+    directories, so its commands are left to the PATH search.'''
+
+    import shlex
+    import tempfile
 
-    enve_vars['ENVE_CURRENT_CONFIG_SHA_256'] = completed_output.stdout.split()[0]
+    if not enve_vars.get('PATH'):
+        return
+
+    command_table = load_dir_index('commands', [path_dir for path_dir in enve_vars['PATH'].split(':') if path_dir],
+                                   is_executable)
+    command_table_content = ''.join('hash -p %s %s\n' % (shlex.quote(command_path), shlex.quote(command)) \
+                                    for command, command_path in command_table)
+
+    # Shells with the same table share the file, so it's named by its content
+    command_table_path = os.path.join(enve_cache.ENVE_CACHE_PATH, 'commands',
+                                      hashlib.sha256(command_table_content.encode()).hexdigest() + '.sh')
+    if os.path.exists(command_table_path):
+        try:
+            # The tables are evicted along with the entries of the commands cache, least recently used first
+            os.utime(command_table_path)
+        except OSError:
+            pass
+    else:
+        try:
+            os.makedirs(os.path.dirname(command_table_path), exist_ok=True)
+            command_table_fd, command_table_tmp_path = tempfile.mkstemp(dir=os.path.dirname(command_table_path),
+                                                                        suffix='.tmp')
+            with os.fdopen(command_table_fd, 'w') as command_table_file:
+                command_table_file.write(command_table_content)
+            os.replace(command_table_tmp_path, command_table_path)
+        except OSError:
+            return
+
+    enve_vars['ENVE_COMMAND_TABLE'] = command_table_path
+
+def get_library_farm_path(lib_dirs: list) -> str:
+    '''Link every shared library in the library directories into one directory, resolving libraries found in more than
+    one directory to the first, the same as the dynamic linker search. Returns the directory, or None if it couldn't be
+    created. Directories with the same links are shared, so they're named by their content.'''
+
+    import tempfile
+
+    library_index = load_dir_index('libraries', lib_dirs, is_shared_library)
+    library_farm_path = os.path.join(enve_cache.ENVE_CACHE_PATH, 'libraries',
+                                     hashlib.sha256(json.dumps(library_index).encode()).hexdigest()[:32])
+    if os.path.isdir(library_farm_path):
+        try:
+            # The farms are evicted along with the entries of the libraries cache, least recently used first
+            os.utime(library_farm_path)
+        except OSError:
+            pass
+        return library_farm_path
+
+    try:
+        os.makedirs(os.path.dirname(library_farm_path), exist_ok=True)
+        # Fill the directory before moving it into place, so a shell never sees it half linked
+        library_farm_tmp_path = tempfile.mkdtemp(dir=os.path.dirname(library_farm_path), suffix='.tmp')
+        for library_name, library_path in library_index:
+            os.symlink(library_path, os.path.join(library_farm_tmp_path, library_name))
+        os.chmod(library_farm_tmp_path, 0o755)
+        os.rename(library_farm_tmp_path, library_farm_path)
+    except OSError:
+        import shutil
+
+        # Another shell moving the same directory into place first is fine
+        shutil.rmtree(library_farm_tmp_path, ignore_errors=True)
+        return library_farm_path if os.path.isdir(library_farm_path) else None
+
+    return library_farm_path
+
+def add_enve_library_farm_variable(enve_vars: dict) -> None:
+    '''Replace each run of read-only directories in the LD_LIBRARY_PATH exported by ENVE with a single directory linking
+    their libraries, so the dynamic linker finds every library in one probe, and gives up on the libraries of the
+    runtime after one probe instead of one per directory. The extensions are mounted read-only, and writable
+    directories such as a project's build output are left as is so new libraries in them are still found.'''
+
+    if not enve_vars.get('LD_LIBRARY_PATH'):
+        return
+
+    def is_read_only(lib_dir: str) -> bool:
+        try:
+            return os.path.isdir(lib_dir) and os.statvfs(lib_dir).f_flag & os.ST_RDONLY != 0
+        except OSError:
+            return False
+
+    lib_dirs = []
+    read_only_lib_dirs = []
+    for lib_dir in [lib_dir for lib_dir in enve_vars['LD_LIBRARY_PATH'].split(':') if lib_dir] + [None]:
+        if lib_dir is not None and is_read_only(lib_dir):
+            read_only_lib_dirs.append(lib_dir)
+            continue
+
+        if len(read_only_lib_dirs) > 1:
+            library_farm_path = get_library_farm_path(read_only_lib_dirs)
+            lib_dirs += [library_farm_path] if library_farm_path else read_only_lib_dirs
+        else:
+            lib_dirs += read_only_lib_dirs
+        read_only_lib_dirs = []
+
+        if lib_dir is not None:
+            lib_dirs.append(lib_dir)
+
+    enve_vars['LD_LIBRARY_PATH'] = ':'.join(lib_dirs)
 
 def add_enve_shell_depth_variable(enve_vars: dict, enve_options: dict) -> None:
     '''Add doc...'''
@@ -106,8 +320,7 @@ def get_flatpak_spawn_cmd(flatpak_spawn_cmd_args: list=[], is_host_cmd: bool=Tru
     if 'FLATPAK_USER_DIR' in os.environ:
         flatpak_spawn_cmd += ['--env=FLATPAK_USER_DIR=%s' % os.environ['FLATPAK_USER_DIR']]
 
-    logger.debug('Flatpak Spawn Command:\n%s',
-                 textwrap.indent(pprint.pformat(flatpak_spawn_cmd + flatpak_spawn_cmd_args), '  '))
+    logger.debug('Flatpak Spawn Command:\n%s', DebugFormat(flatpak_spawn_cmd + flatpak_spawn_cmd_args))
 
     return flatpak_spawn_cmd + flatpak_spawn_cmd_args
 
@@ -122,26 +335,74 @@ def get_flatpak_cmd(enve_options: dict, flatpak_cmd_args: list=[]) -> list:
 
     return flatpak_cmd + flatpak_cmd_args
 
-def extension_verify_installed(enve_vars: dict, enve_options: dict, flatpak_extension: dict) -> dict:
-    '''Add doc...'''
+def load_flatpak_inventory(enve_options: dict) -> dict:
+    '''Snapshot the runtimes installed in the flatpak installation with a single host query, indexed by ref.'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
-    verify_results = {'is_installed': True, 'is_new_install': False}
-
-    # We have to run flatpak commands in the host environment. A return code of 0 from flatpak info indicates
-    # the extension is installed.
-    flatpak_cmd_args = ['info', '--show-origin', flatpak_extension['flatpak']]
+    # We have to run flatpak commands in the host environment. Extensions are installed as runtimes, and the active
+    # column is the commit SHA currently deployed. The columns are shortened unless the full (:f) format is asked for,
+    # which would cut the commit down to 12 characters.
+    flatpak_cmd_args = ['list', '--runtime', '--columns=ref:f,origin:f,active:f']
     flatpak_spawn_cmd = get_flatpak_spawn_cmd(get_flatpak_cmd(enve_options, flatpak_cmd_args))
-    completed_output = subprocess.run(flatpak_spawn_cmd, capture_output=True, text=True)
+    with enve_profile.span('flatpak list'):
+        completed_output = subprocess.run(flatpak_spawn_cmd, capture_output=True, text=True)
+    if completed_output.returncode != 0:
+        logger.error('Unable to list flatpak installation "%s":\n%s',
+                     enve_options['use-flatpak-installation'].value(), textwrap.indent(completed_output.stderr, '  '))
+        exit(completed_output.returncode)
+
+    flatpak_inventory = {}
+    for line in completed_output.stdout.splitlines():
+        columns = line.split('\t')
+        # Skip anything that isn't a ref row, such as a column header
+        if len(columns) == 3 and columns[0].count('/') == 2:
+            flatpak_inventory[columns[0].strip()] = {'origin': columns[1].strip(), 'commit': columns[2].strip()}
+
+    logger.debug('Flatpak Inventory:\n%s', DebugFormat(flatpak_inventory))
+    return flatpak_inventory
+
+def get_enve_proxy_vars(enve_vars: dict) -> list:
+    '''Get the flatpak-spawn --env arguments for any proxy variables passed, as we will need internet access for
+    extension installation.'''
+
+    return ['--env=%s=%s' % (enve_var, enve_vars[enve_var]) \
+            for enve_var in enve_vars if re.search('^(https?|ftp|no)_proxy$', enve_var, re.IGNORECASE)]
+
+def run_flatpak_transaction(enve_vars: dict, enve_options: dict, flatpak_cmd_args: list,
+                            flatpak_extensions: list) -> bool:
+    '''Run a single flatpak transaction on the host for all the given extensions. Returns True if it succeeded.'''
+
+    flatpak_cmd_args = flatpak_cmd_args + [flatpak_extension['flatpak'] for flatpak_extension in flatpak_extensions]
+    flatpak_spawn_cmd_args = get_enve_proxy_vars(enve_vars) + get_flatpak_cmd(enve_options, flatpak_cmd_args)
+
+    with enve_profile.span('flatpak %s' % flatpak_cmd_args[0], args=flatpak_cmd_args):
+        return subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode == 0
 
-    is_install_needed = completed_output.returncode != 0
-    original_remote_name = '' if is_install_needed else completed_output.stdout.strip()
+def extensions_verify_installed(enve_vars: dict, enve_options: dict, flatpak_extensions: list,
+                                flatpak_inventory: dict) -> dict:
+    '''Verify all the extensions are installed from the right remote. Any extensions installed from a different remote
+    are removed in one transaction, and all the missing extensions are installed with one transaction per remote.'''
 
-    # Check to see if we need to re-install the extension from a different remote
-    if is_install_needed == False and flatpak_extension['remote_name'] != '':
-        if original_remote_name != flatpak_extension['remote_name']:
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    verify_results = {'is_installed': True, 'is_new_install': False}
+
+    install_extensions = []
+    remove_extensions = []
+    original_remote_names = {}
+    for flatpak_extension in flatpak_extensions:
+        # The extension is installed if it's in the installation inventory.
+        if flatpak_extension['flatpak'] not in flatpak_inventory:
+            logger.warning('"%s" extension missing, installing...', flatpak_extension['id'])
+            install_extensions.append(flatpak_extension)
+            continue
+
+        # Check to see if we need to re-install the extension from a different remote
+        original_remote_name = flatpak_inventory[flatpak_extension['flatpak']]['origin']
+        if flatpak_extension['remote_name'] != '' and original_remote_name != flatpak_extension['remote_name']:
             logger.warning('"%s" extension is currently installed from remote "%s" instead of "%s". Removing...',
                            flatpak_extension['id'], original_remote_name, flatpak_extension['remote_name'])
 
@@ -153,145 +414,171 @@ def extension_verify_installed(enve_vars: dict, enve_options: dict, flatpak_exte
                 logger.error('Try exiting the container first before loading new config "%s".',
                              enve_options['use-config'].value())
                 verify_results['is_installed'] = False
-                logger.debug('Verify Installed Results: %s' % verify_results)
+                logger.debug('Verify Installed Results: %s', verify_results)
                 return verify_results
 
-            flatpak_spawn_cmd_args = \
-                get_flatpak_cmd(enve_options, ['remove', '--assumeyes', flatpak_extension['flatpak']])
-
-            # Remove the current install as it was installed from a different remote than the one specified
-            if subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode != 0:
-                # The installation of the extension failed, meaning we can't load the specified environment and will
-                # have to abort.
+            original_remote_names[flatpak_extension['flatpak']] = original_remote_name
+            remove_extensions.append(flatpak_extension)
+            install_extensions.append(flatpak_extension)
+
+    # Remove the current installs as they were installed from a different remote than the one specified
+    if remove_extensions and \
+       not run_flatpak_transaction(enve_vars, enve_options, ['remove', '--assumeyes'], remove_extensions):
+        # Report the extensions that are still installed. The removal failed, meaning we can't load the specified
+        # environment and will have to abort.
+        flatpak_inventory = load_flatpak_inventory(enve_options)
+        for flatpak_extension in remove_extensions:
+            if flatpak_extension['flatpak'] in flatpak_inventory:
                 logger.error('"%s" extension removal failed.', flatpak_extension['id'])
-                verify_results['is_installed'] = False
-                logger.debug('Verify Installed Results: %s' % verify_results)
-                return verify_results
-
-            is_install_needed = True
-
-    if is_install_needed == True:
-        logger.warning('"%s" extension missing, installing...', flatpak_extension['id'])
-
-        # Extract any proxy variables passed as we will need internet access for extension installation
-        enve_proxy_vars = \
-            ['--env=%s=%s' % (enve_var, enve_vars[enve_var]) \
-             for enve_var in enve_vars if re.search('^(https?|ftp|no)_proxy$', enve_var, re.IGNORECASE)]
-
-        flatpak_cmd_args = \
-            ['install', '--assumeyes'] + \
-            ([flatpak_extension['remote_name']] if flatpak_extension['remote_name'] != '' else []) + \
-            [flatpak_extension['flatpak']]
-
-        flatpak_spawn_cmd_args = enve_proxy_vars + get_flatpak_cmd(enve_options, flatpak_cmd_args)
-        # The extension is missing, so attempt to install. A return code of 0 means it installed successfully.
-        if subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode != 0:
-
-            # If the enve extension install failed, try to restore a working copy before dying
-            if flatpak_extension['id'] == 'enve' and original_remote_name != '':
-                logger.warning('"%s" base extension was removed. Attempt to restore from remote "%s"...',
-                               flatpak_extension['id'], original_remote_name)
-
-                flatpak_cmd_args = \
-                    ['install', '--assumeyes', original_remote_name, flatpak_extension['flatpak']]
-                flatpak_spawn_cmd_args = enve_proxy_vars + get_flatpak_cmd(enve_options, flatpak_cmd_args)
-                if subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args), capture_output=True).returncode != 0:
-                    logger.warning('"%s" base extension restore from "%s" failed.', flatpak_extension['id'],
-                                   original_remote_name)
-                else:
-                    logger.warning('"%s" base extension was restored from remote "%s".', flatpak_extension['id'],
-                                   original_remote_name)
-
-            # The installation of the extension failed, meaning we can't load the specified environment and will
-            # have to abort.
-            if flatpak_extension['remote_name'] != '':
-                logger.error('"%s" extension install from remote "%s" failed.', flatpak_extension['id'],
-                             flatpak_extension['remote_name'])
+        verify_results['is_installed'] = False
+        logger.debug('Verify Installed Results: %s', verify_results)
+        return verify_results
+
+    if not install_extensions:
+        logger.debug('Verify Installed Results: %s', verify_results)
+        return verify_results
+
+    # flatpak install takes a single remote, so group the installs by remote. Extensions without a remote specified let
+    # flatpak pick the remote.
+    remote_install_extensions = collections.OrderedDict()
+    for flatpak_extension in install_extensions:
+        remote_install_extensions.setdefault(flatpak_extension['remote_name'], []).append(flatpak_extension)
+
+    is_install_failed = False
+    for remote_name, remote_extensions in remote_install_extensions.items():
+        flatpak_cmd_args = ['install', '--assumeyes'] + ([remote_name] if remote_name != '' else [])
+        is_install_failed |= \
+            not run_flatpak_transaction(enve_vars, enve_options, flatpak_cmd_args, remote_extensions)
+
+    # A failed transaction may still have installed some of the extensions, so check each of them individually.
+    failed_extensions = []
+    if is_install_failed:
+        flatpak_inventory = load_flatpak_inventory(enve_options)
+        failed_extensions = [flatpak_extension for flatpak_extension in install_extensions \
+                             if flatpak_extension['flatpak'] not in flatpak_inventory]
+
+    for flatpak_extension in failed_extensions:
+        # If the enve extension install failed, try to restore a working copy before dying
+        original_remote_name = original_remote_names.get(flatpak_extension['flatpak'], '')
+        if flatpak_extension['id'] == 'enve' and original_remote_name != '':
+            logger.warning('"%s" base extension was removed. Attempt to restore from remote "%s"...',
+                           flatpak_extension['id'], original_remote_name)
+
+            flatpak_cmd_args = \
+                get_enve_proxy_vars(enve_vars) + \
+                get_flatpak_cmd(enve_options,
+                                ['install', '--assumeyes', original_remote_name, flatpak_extension['flatpak']])
+            with enve_profile.span('flatpak install', args=flatpak_cmd_args):
+                is_restored = \
+                    subprocess.run(get_flatpak_spawn_cmd(flatpak_cmd_args), capture_output=True).returncode == 0
+            if not is_restored:
+                logger.warning('"%s" base extension restore from "%s" failed.', flatpak_extension['id'],
+                               original_remote_name)
             else:
-                logger.error('"%s" extension install failed.', flatpak_extension['id'])
-
-            verify_results['is_installed'] = False
-            logger.debug('Verify Installed Results: %s' % verify_results)
-            return verify_results
+                logger.warning('"%s" base extension was restored from remote "%s".', flatpak_extension['id'],
+                               original_remote_name)
+
+        # The installation of the extension failed, meaning we can't load the specified environment and will have to
+        # abort.
+        if flatpak_extension['remote_name'] != '':
+            logger.error('"%s" extension install from remote "%s" failed.', flatpak_extension['id'],
+                         flatpak_extension['remote_name'])
+        else:
+            logger.error('"%s" extension install failed.', flatpak_extension['id'])
 
-        verify_results['is_new_install'] = True
-        logger.info('"%s" extension install succeeded.', flatpak_extension['id'])
+    for flatpak_extension in install_extensions:
+        if flatpak_extension not in failed_extensions:
+            logger.info('"%s" extension install succeeded.', flatpak_extension['id'])
 
-    logger.debug('Verify Installed Results: %s' % verify_results)
+    verify_results['is_installed'] = not failed_extensions
+    verify_results['is_new_install'] = len(failed_extensions) != len(install_extensions)
+    logger.debug('Verify Installed Results: %s', verify_results)
     return verify_results
 
-def extension_verify_commit(enve_vars: dict, enve_options: dict, flatpak_extension: dict) -> dict:
-    '''Add doc...'''
+def extensions_verify_commit(enve_vars: dict, enve_options: dict, flatpak_extensions: list,
+                             flatpak_inventory: dict) -> dict:
+    '''Verify all the installed extensions match their specified commit. Extensions without a commit mismatch are
+    updated together in one transaction. flatpak only accepts a single ref with --commit, so each commit mismatch is
+    its own transaction.'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
     verify_results = {'is_installed': True, 'is_new_install': False}
 
-    is_commit_installed = flatpak_extension['commit'] == 'current_installed'
+    update_extensions = []
+    commit_extensions = []
+    for flatpak_extension in flatpak_extensions:
+        is_commit_installed = flatpak_extension['commit'] == 'current_installed'
 
-    # Verify the installed flatpak extension matches the commit SHA if specified.
-    if is_commit_installed == False and flatpak_extension['commit'] != 'latest':
-
-        # Get the flatpak extension commit SHA
-        flatpak_spawn_cmd = get_flatpak_spawn_cmd(get_flatpak_cmd(enve_options, ['info', '--show-commit',
-                                                                                 flatpak_extension['flatpak']]))
-        completed_output = subprocess.run(flatpak_spawn_cmd, capture_output=True, text=True)
-        # We already verified the extension is installed earlier, so expect the flatpak query to succeed.
-        if completed_output.returncode != 0:
-            logger.error('Unable to get info for %s:\n%s', flatpak_extension['id'],
-                         textwrap.indent(completed_output.stderr, '  '))
-            verify_results['is_installed'] = False
-            logger.debug('Verify Commit Results: %s' % verify_results)
-            return verify_results
-
-        # If the commit SHA does not match the currently installed commit SHA, update the installed flatpak to
-        # the specified commit SHA.
-        is_commit_installed = \
-            flatpak_extension['commit'] == completed_output.stdout.strip()[:len(flatpak_extension['commit'])]
-
-    # Update the installed flatpak if the specified commit is not installed or update install was passed
-    if is_commit_installed == False or enve_options['update-install'].value() == True:
-
-        # Extension updates to a specific commit can not be done dynamically as it will affect the container
-        # stack. Therefore, only allow extensions to be updates to a specific commit when running outside of a
-        # container.
-        if 'ENVE_SHELL_DEPTH' in os.environ:
-            logger.error('"%s" extension update to commit failed. ' +
-                         'Cannot update extension to commit when inside container.',
-                         flatpak_extension['id'])
-            logger.error('Try exiting the container first before loading new config "%s".',
-                         enve_options['use-config'].value())
-            verify_results['is_installed'] = False
-            logger.debug('Verify Commit Results: %s' % verify_results)
-            return verify_results
-
-        # Extract any proxy variables passed as we will need internet access for extension installation
-        enve_proxy_vars = \
-            ['--env=%s=%s' % (enve_var, enve_vars[enve_var]) \
-             for enve_var in enve_vars if re.search('^(https?|ftp|no)_proxy$', enve_var, re.IGNORECASE)]
-
-        # Update the flatpak
-        flatpak_cmd_args = ['update', '--assumeyes', flatpak_extension['flatpak']]
+        # Verify the installed flatpak extension matches the commit SHA if specified.
         if is_commit_installed == False and flatpak_extension['commit'] != 'latest':
-            flatpak_cmd_args += ['--commit', flatpak_extension['commit']]
-            # If update install was not passed, warn that we found a commit mismatch and are updating
-            if enve_options['update-install'].value() == False:
-                logger.warning('%s installed commit mismatch, updating...', flatpak_extension['id'])
-
-        flatpak_spawn_cmd_args = enve_proxy_vars + get_flatpak_cmd(enve_options, flatpak_cmd_args)
-        if subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode != 0:
-            # The update of the extension failed, meaning we can't load the specified environment and will
-            # have to abort loading the environment.
-            logger.error('"%s" extension update failed.', flatpak_extension['id'])
-            verify_results['is_installed'] = False
-            logger.debug('Verify Commit Results: %s' % verify_results)
-            return verify_results
 
-        verify_results['is_new_install'] = True
-        logger.info('"%s" extension update succeeded.', flatpak_extension['id'])
+            # We already verified the extension is installed earlier, so expect it to be in the inventory.
+            if flatpak_extension['flatpak'] not in flatpak_inventory:
+                logger.error('Unable to get info for %s: not found in flatpak installation "%s".',
+                             flatpak_extension['id'], enve_options['use-flatpak-installation'].value())
+                verify_results['is_installed'] = False
+                logger.debug('Verify Commit Results: %s', verify_results)
+                return verify_results
+
+            # If the commit SHA does not match the currently installed commit SHA, update the installed flatpak to
+            # the specified commit SHA.
+            installed_commit = flatpak_inventory[flatpak_extension['flatpak']]['commit']
+            is_commit_installed = flatpak_extension['commit'] == installed_commit[:len(flatpak_extension['commit'])]
+
+        # Update the installed flatpak if the specified commit is not installed or update install was passed
+        if is_commit_installed == False or enve_options['update-install'].value() == True:
+
+            # Extension updates to a specific commit can not be done dynamically as it will affect the container
+            # stack. Therefore, only allow extensions to be updates to a specific commit when running outside of a
+            # container.
+            if 'ENVE_SHELL_DEPTH' in os.environ:
+                logger.error('"%s" extension update to commit failed. ' +
+                             'Cannot update extension to commit when inside container.',
+                             flatpak_extension['id'])
+                logger.error('Try exiting the container first before loading new config "%s".',
+                             enve_options['use-config'].value())
+                verify_results['is_installed'] = False
+                logger.debug('Verify Commit Results: %s', verify_results)
+                return verify_results
+
+            if is_commit_installed == False and flatpak_extension['commit'] != 'latest':
+                commit_extensions.append(flatpak_extension)
+                # If update install was not passed, warn that we found a commit mismatch and are updating
+                if enve_options['update-install'].value() == False:
+                    logger.warning('%s installed commit mismatch, updating...', flatpak_extension['id'])
+            else:
+                update_extensions.append(flatpak_extension)
+
+    failed_extensions = []
+
+    # Update the flatpaks without a specific commit together. If the transaction fails, retry each individually to
+    # find out which of them failed.
+    if update_extensions and \
+       not run_flatpak_transaction(enve_vars, enve_options, ['update', '--assumeyes'], update_extensions):
+        failed_extensions += \
+            [flatpak_extension for flatpak_extension in update_extensions \
+             if len(update_extensions) == 1 or \
+                not run_flatpak_transaction(enve_vars, enve_options, ['update', '--assumeyes'], [flatpak_extension])]
+
+    # Update the flatpaks to their specified commits
+    for flatpak_extension in commit_extensions:
+        flatpak_cmd_args = ['update', '--assumeyes', '--commit', flatpak_extension['commit']]
+        if not run_flatpak_transaction(enve_vars, enve_options, flatpak_cmd_args, [flatpak_extension]):
+            failed_extensions.append(flatpak_extension)
+
+    # The update of the extension failed, meaning we can't load the specified environment and will have to abort
+    # loading the environment.
+    for flatpak_extension in update_extensions + commit_extensions:
+        if flatpak_extension in failed_extensions:
+            logger.error('"%s" extension update failed.', flatpak_extension['id'])
+        else:
+            logger.info('"%s" extension update succeeded.', flatpak_extension['id'])
 
-    logger.debug('Verify Commit Results: %s' % verify_results)
+    verify_results['is_installed'] = not failed_extensions
+    verify_results['is_new_install'] = len(failed_extensions) != len(update_extensions + commit_extensions)
+    logger.debug('Verify Commit Results: %s', verify_results)
     return verify_results
 
 def import_callback(dir_path: str, filename:str) -> [str, str]:
@@ -305,14 +592,58 @@ def import_callback(dir_path: str, filename:str) -> [str, str]:
         with open(abs_path) as enve_libsonnet:
             return abs_path, enve_libsonnet.read()
 
-def load_variables(enve_options: dict, enve_id: dict, variables: list) -> dict:
+def load_enve_json(config_path: str) -> [dict, list]:
+    '''Evaluate the ENVE config, returning the Enve object and the files it imports. The evaluated Enve object is cached
+    on disk keyed on the content of the config and every file it imports, so an unchanged config skips Jsonnet.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    config_path = os.path.abspath(config_path)
+    # The config cache counts its hits and misses across runs for the debug log
+    config_cache = enve_cache.EnveCache('config', is_stats_persisted=True)
+
+    # A cached entry is only valid if the config and all of its imports still have the same content
+    cache_entry = config_cache.get(config_path, is_valid=lambda cache_entry: cache_entry['fingerprint'] == \
+                                   enve_cache.files_sha256([config_path] + cache_entry['imports']))
+    logger.debug('ENVE config cache %s (hits: %d, misses: %d)', 'hit' if cache_entry else 'miss',
+                 config_cache.stats()['hits'], config_cache.stats()['misses'])
+    if cache_entry:
+        return cache_entry['enve'], cache_entry['imports']
+
+    import _jsonnet
+
+    with open(config_path, 'rb') as config_file:
+        config_content = config_file.read()
+
+    # Record the digest of every file Jsonnet imports so the cache entry can be validated without evaluating
+    import_digests = collections.OrderedDict()
+    def record_import_callback(dir_path: str, filename: str) -> [str, str]:
+        import_path, import_content = import_callback(dir_path, filename)
+        with open(import_path, 'rb') as import_file:
+            import_digests[import_path] = hashlib.sha256(import_file.read()).hexdigest()
+        return import_path, import_content
+
+    enve_json = json.loads(_jsonnet.evaluate_snippet(config_path, config_content.decode(),
+                                                     import_callback=record_import_callback))['Enve']
+
+    config_cache.put(config_path, {
+        'fingerprint': enve_cache.sha256_lines([(config_path, hashlib.sha256(config_content).hexdigest())] +
+                                               list(import_digests.items())),
+        'imports': list(import_digests),
+        'enve': enve_json})
+
+    return enve_json, list(import_digests)
+
+def load_variables(enve_options: dict, enve_id: dict, variables: list, enve_delimiters: dict,
+                   config_imports: list) -> dict:
     '''Add doc...'''
 
     # Initialize the ENVE variables dictionary
     enve_vars = { 'ENV': ENVE_BASHRC_PATH, 'BASH_ENV': ENVE_BASHRC_PATH }
 
     # Add the ENVE global variables
-    add_variables(enve_vars, variables,
+    add_variables(enve_vars, enve_delimiters, variables,
                   # The base path for global variables is the config file directory
                   base_path=os.path.dirname(os.path.abspath(enve_options['use-config'].value())))
 
@@ -326,15 +657,21 @@ def load_variables(enve_options: dict, enve_id: dict, variables: list) -> dict:
     add_enve_prompt_variable(enve_vars, enve_options)
 
     # Add the ENVE current config variables
-    add_enve_current_config_variables(enve_vars, enve_options)
+    add_enve_current_config_variables(enve_vars, enve_options, config_imports)
+    add_enve_config_stamp_variable(enve_vars)
 
     # Add the ENVE flatpak installation variables
     add_enve_flatpak_installation_variable(enve_vars, enve_options)
 
     return enve_vars
 
-def add_variables(enve_vars: dict, variables: list, extension_alias: str='', base_path: str='') -> None:
-    '''Add doc...'''
+def add_variables(enve_vars: dict, enve_delimiters: dict, variables: list, extension_alias: str='',
+                  base_path: str='') -> None:
+    '''Add the variables to enve_vars, recording the delimiter of each delimited variable in enve_delimiters. The
+    values of delimited variables are built up as lists of their elements, joined once by join_variables. Path and ":"
+    delimited variables are built as ordered sets instead, so every element is only kept where it first appears, while
+    other variables such as compiler flags keep every element. The inherited environment values are merged in later by
+    export_variables.'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
@@ -351,7 +688,7 @@ def add_variables(enve_vars: dict, variables: list, extension_alias: str='', bas
         # Ensure that export variable names are not prefixed with 'ENVE_'
         invalid_exports = [export for export in variable['exports'] if export.find('ENVE_') == 0]
         if invalid_exports:
-            for invalid_export in inavlid_exports:
+            for invalid_export in invalid_exports:
                 logger.error('ENVE export variable name prefixed with "ENVE_": %s', invalid_export)
             exit(1)
 
@@ -361,46 +698,288 @@ def add_variables(enve_vars: dict, variables: list, extension_alias: str='', bas
         else:
             variable_names += ['_'.join(['ENVE', variable['name']]).upper()]
 
+        # The first declaration of a variable decides whether it's built as an ordered set
+        is_set = variable['values_are_paths'] or variable['delimiter'] == ':'
+
         for variable_name in variable_names:
             if variable['delimiter'] == '':
                 enve_vars[variable_name] = value
-            elif variable_name in enve_vars:
-                enve_vars[variable_name] += variable['delimiter'] + value
-            elif variable['delimit_first']:
-                enve_vars[variable_name] = variable['delimiter'] + value
+                enve_delimiters.pop(variable_name, None)
+                continue
+            elif variable_name not in enve_vars:
+                # An empty first element gives the leading delimiter
+                elements = [''] if variable['delimit_first'] else []
+                enve_vars[variable_name] = dict.fromkeys(elements) if is_set else elements
+            elif isinstance(enve_vars[variable_name], str):
+                elements = [enve_vars[variable_name]]
+                enve_vars[variable_name] = dict.fromkeys(elements) if is_set else elements
+
+            if isinstance(enve_vars[variable_name], dict):
+                enve_vars[variable_name].update(dict.fromkeys(value.split(variable['delimiter'])))
             else:
-                enve_vars[variable_name] = value
+                enve_vars[variable_name] += value.split(variable['delimiter'])
+            enve_delimiters[variable_name] = {'delimiter': variable['delimiter'],
+                                              'is_set': isinstance(enve_vars[variable_name], dict)}
 
-        for variable_name in variable_names:
-            if variable_name.find('ENVE_') != 0 and variable['delimiter'] != '':
-                os_environ_var = os.environ.get(variable_name, '').strip(variable['delimiter'])
-                if os_environ_var != '':
-                    enve_vars[variable_name] = \
-                        enve_vars[variable_name].replace(variable['delimiter'] + os_environ_var, '')
-                    enve_vars[variable_name] += variable['delimiter'] + os_environ_var
-
-def export_variables(enve_vars: dict, is_new_enve_shell_needed: bool) -> None:
-    '''Add doc...'''
+def get_flatpak_extension_commits() -> dict:
+    '''The commit of every extension mounted in the running sandbox, indexed by extension ID.'''
+
+    import configparser
+
+    flatpak_info = configparser.ConfigParser(interpolation=None)
+    try:
+        flatpak_info.read(ENVE_FLATPAK_INFO_PATH)
+    except configparser.Error:
+        return {}
+
+    # Mounted extensions are listed as "ID=COMMIT;..."
+    extension_commits = {}
+    for extensions_key in ['runtime-extensions', 'app-extensions']:
+        for extension_commit in flatpak_info.get('Instance', extensions_key, fallback='').split(';'):
+            if '=' in extension_commit:
+                extension_id, _, commit = extension_commit.partition('=')
+                extension_commits[extension_id] = commit
+
+    return extension_commits
+
+def load_path_index(flatpak_extensions: list, extension_commits: dict) -> dict:
+    '''Index which of the directories declared by the extension path variables exist, indexed by directory. The
+    existence of an extension's directories is cached by the commit mounted in the running sandbox, given by
+    extension_commits, so it's only checked once per commit. Extensions not mounted in the running sandbox are left
+    out, as their directories can't be checked.'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
-    logger.debug('ENVE Variables:\n%s', textwrap.indent(pprint.pformat(enve_vars), '  '))
+    path_cache = enve_cache.EnveCache('paths')
+    path_index = {}
+    for flatpak_extension in flatpak_extensions:
+        if not os.path.isdir(flatpak_extension['path']):
+            continue
+
+        extension_dirs = [value for variable in flatpak_extension['variables'] if variable['values_are_paths'] \
+                          for value in variable['values'] if value]
+
+        extension_id = flatpak_extension['flatpak'].split('/')[0]
+        cache_key = '%s\n%s' % (flatpak_extension['flatpak'], extension_commits.get(extension_id, ''))
+        extension_index = path_cache.get(cache_key) if extension_id in extension_commits else None
+        extension_index = extension_index or {}
+
+        unindexed_dirs = [extension_dir for extension_dir in extension_dirs if extension_dir not in extension_index]
+        if unindexed_dirs:
+            extension_index.update({extension_dir: os.path.isdir(extension_dir) for extension_dir in unindexed_dirs})
+            if extension_id in extension_commits:
+                path_cache.put(cache_key, extension_index)
+
+        path_index.update((extension_dir, extension_index[extension_dir]) for extension_dir in extension_dirs)
+
+    logger.debug('Path Index:\n%s', DebugFormat(path_index))
+    return path_index
+
+def prune_variables(enve_vars: dict, enve_delimiters: dict, path_index: dict) -> None:
+    '''Remove the directories the path index found missing from the exported delimited variables built by
+    add_variables. The ENVE_ variables keep every declared directory.'''
+
+    for variable_name in enve_delimiters:
+        if variable_name.find('ENVE_') != 0 and not isinstance(enve_vars[variable_name], str):
+            elements = [element for element in enve_vars[variable_name] if path_index.get(element) != False]
+            enve_vars[variable_name] = \
+                dict.fromkeys(elements) if isinstance(enve_vars[variable_name], dict) else elements
+
+def join_variables(enve_vars: dict, enve_delimiters: dict) -> dict:
+    '''Return a copy of enve_vars with the elements of the delimited variables built by add_variables joined.'''
+
+    return {variable_name: value if isinstance(value, str) else \
+            enve_delimiters[variable_name]['delimiter'].join(value) for variable_name, value in enve_vars.items()}
+
+def merge_environ_variables(enve_vars: dict, enve_delimiters: dict, environ: dict=os.environ) -> dict:
+    '''Return a copy of enve_vars with the values inherited from environ, the current environment by default,
+    appended to the delimited variables. Inherited elements already in the value of an ordered set variable are not
+    repeated, and the inherited value of any other variable replaces the ENVE value it starts with, so merging into an
+    environment exported by an ENVE shell doesn't grow the variables.'''
+
+    enve_vars = dict(enve_vars)
+    for variable_name, enve_delimiter in enve_delimiters.items():
+        if variable_name.find('ENVE_') != 0:
+            delimiter = enve_delimiter['delimiter']
+            value = enve_vars[variable_name]
+            os_environ_var = environ.get(variable_name, '').strip(delimiter)
+            if os_environ_var == '':
+                continue
+            elif enve_delimiter['is_set']:
+                elements = dict.fromkeys(value.split(delimiter))
+                elements.update(dict.fromkeys(os_environ_var.split(delimiter)))
+                enve_vars[variable_name] = delimiter.join(elements)
+            elif (os_environ_var + delimiter).startswith(value.strip(delimiter) + delimiter):
+                # Exported by an ENVE shell, so only the leading delimiter of the ENVE value is kept
+                enve_vars[variable_name] = value[:len(value) - len(value.lstrip(delimiter))] + os_environ_var
+            else:
+                enve_vars[variable_name] = value + delimiter + os_environ_var
+
+    return enve_vars
+
+def export_variables(enve_vars: dict, enve_delimiters: dict, is_new_enve_shell_needed: bool) -> None:
+    '''Add doc...'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
 
     # Export the ENVE variables into the current environment only if new shell is not needed
     if is_new_enve_shell_needed == False:
+        enve_vars = merge_environ_variables(enve_vars, enve_delimiters)
         for enve_var in enve_vars:
             os.environ[enve_var] = enve_vars[enve_var]
 
-def load_enve_config(enve_options: dict) -> dict:
-    '''Add doc...'''
+    logger.debug('ENVE Variables:\n%s', DebugFormat(enve_vars))
+
+def dump_enve_snapshot(enve_options: dict, load_results: dict, is_new_enve_shell_needed: bool=False) -> str:
+    '''Serialize the resolved ENVE variables into a compact snapshot for a spawned ENVE process. If
+    is_new_enve_shell_needed, the spawned ENVE process has to spawn a new ENVE shell for the environment in turn, such
+    as when an extension was installed after it was started. Returns None if the snapshot is too large to pass through
+    the environment.'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
-    # We always spawn a new shell if we're loading an enve_config from an existing ENVE shell to ensure isolation of the
-    # requested command.
-    load_results = {'is_new_enve_shell_needed': 'ENVE_ID' in os.environ}
+    enve_snapshot = {
+        'config': os.path.abspath(enve_options['use-config'].value()),
+        'config_sha_256': load_results['enve_vars']['ENVE_CURRENT_CONFIG_SHA_256'],
+        'enve_vars': load_results['enve_vars'],
+        'enve_delimiters': load_results['enve_delimiters'],
+        'is_new_enve_shell_needed': is_new_enve_shell_needed}
+    enve_snapshot = base64.b64encode(zlib.compress(json.dumps(enve_snapshot).encode())).decode()
+
+    if len(enve_snapshot) > ENVE_SNAPSHOT_MAX_SIZE:
+        logger.debug('ENVE snapshot too large to pass (%d bytes)', len(enve_snapshot))
+        return None
+
+    return enve_snapshot
+
+def load_enve_snapshot(enve_options: dict) -> dict:
+    '''Load the ENVE snapshot handed over by the parent ENVE process. Returns None if there is no snapshot, or it
+    doesn't match the current config.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    # Don't leak the snapshot into the environment of the command
+    if 'ENVE_SNAPSHOT' not in os.environ:
+        return None
+    enve_snapshot = os.environ.pop('ENVE_SNAPSHOT')
+
+    try:
+        enve_snapshot = json.loads(zlib.decompress(base64.b64decode(enve_snapshot)))
+    except (ValueError, zlib.error):
+        logger.debug('Ignoring invalid ENVE snapshot')
+        return None
+
+    if enve_snapshot['config'] != os.path.abspath(enve_options['use-config'].value()) or \
+       enve_snapshot['config_sha_256'] != \
+       get_config_sha_256(enve_snapshot['enve_vars']['ENVE_CURRENT_CONFIG_FILES'].split('\n')):
+        logger.debug('Ignoring ENVE snapshot for a different config')
+        return None
+
+    return enve_snapshot
+
+def get_enve_lock_path(config_path: str) -> str:
+    '''The lockfile lives next to the config, e.g. enve.jsonnet is locked by enve.lock.'''
+
+    return os.path.splitext(os.path.abspath(config_path))[0] + '.lock'
+
+def write_enve_lock(enve_options: dict, enve_vars: dict, enve_delimiters: dict, config_imports: list,
+                    flatpak_extensions: list, flatpak_inventory: dict) -> str:
+    '''Write the lockfile pinning the installed commit of every extension along with the fully expanded variables.
+    Returns the lockfile path.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    enve_lock_path = get_enve_lock_path(enve_options['use-config'].value())
+    enve_lock = {
+        'config': os.path.abspath(enve_options['use-config'].value()),
+        'config_sha_256': enve_vars['ENVE_CURRENT_CONFIG_SHA_256'],
+        'imports': config_imports,
+        'flatpak_installation': enve_options['use-flatpak-installation'].value(),
+        'prune_paths': enve_options['use-prune-paths'].value(),
+        'extensions': [{'id': flatpak_extension['id'],
+                        'flatpak': flatpak_extension['flatpak'],
+                        'remote_name': flatpak_inventory[flatpak_extension['flatpak']]['origin'],
+                        'commit': flatpak_inventory[flatpak_extension['flatpak']]['commit']} \
+                       for flatpak_extension in flatpak_extensions],
+        'enve_vars': enve_vars,
+        'enve_delimiters': enve_delimiters}
+
+    try:
+        with open(enve_lock_path, 'w') as enve_lock_file:
+            json.dump(enve_lock, enve_lock_file, indent=2, sort_keys=True)
+            enve_lock_file.write('\n')
+    except OSError as err:
+        logger.error('Unable to write ENVE lock "%s": %s', enve_lock_path, err)
+        exit(1)
+
+    return enve_lock_path
+
+def load_enve_lock(enve_options: dict) -> dict:
+    '''Load the lockfile for the config. Returns None if there is no lockfile, or it is older than the config or any of
+    its imports.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    enve_lock_path = get_enve_lock_path(enve_options['use-config'].value())
+    try:
+        enve_lock_mtime = os.stat(enve_lock_path).st_mtime_ns
+        with open(enve_lock_path) as enve_lock_file:
+            enve_lock = json.load(enve_lock_file)
+    except (OSError, ValueError):
+        return None
+
+    # The lock only applies to the config and flatpak installation it was written for
+    if enve_lock['config'] != os.path.abspath(enve_options['use-config'].value()) or \
+       enve_lock['flatpak_installation'] != enve_options['use-flatpak-installation'].value():
+        logger.debug('Ignoring ENVE lock "%s" written for a different config or installation', enve_lock_path)
+        return None
+
+    # The locked variables are only pruned if the lock was written with use-prune-paths
+    if enve_lock.get('prune_paths', False) != enve_options['use-prune-paths'].value():
+        logger.debug('Ignoring ENVE lock "%s" written with a different use-prune-paths', enve_lock_path)
+        return None
+
+    # Locks written before the config imports were fingerprinted, or before the delimited variables recorded whether
+    # they're ordered sets, have to be written again
+    if 'ENVE_CURRENT_CONFIG_FILES' not in enve_lock['enve_vars'] or \
+       not all(isinstance(enve_delimiter, dict) for enve_delimiter in enve_lock['enve_delimiters'].values()):
+        logger.info('ENVE lock "%s" is out of date, run "update-lock" again.', enve_lock_path)
+        return None
+
+    for config_path in [enve_lock['config']] + enve_lock['imports']:
+        try:
+            is_stale = os.stat(config_path).st_mtime_ns >= enve_lock_mtime
+        except OSError:
+            is_stale = True
+
+        if is_stale:
+            logger.info('ENVE lock "%s" is out of date with "%s".', enve_lock_path, config_path)
+            return None
+
+    # The locked variables point at the locked extensions, so the lock is only good while they're still installed
+    installed_commits = get_installed_extension_commits(
+        enve_options, [flatpak_extension['flatpak'] for flatpak_extension in enve_lock['extensions']])
+    for flatpak_extension in enve_lock['extensions']:
+        installed_commit = installed_commits[flatpak_extension['flatpak']]
+        # Locks written from a shortened inventory only have the start of the commit
+        if installed_commit is None or not installed_commit.startswith(flatpak_extension['commit']):
+            logger.info('ENVE lock "%s" is out of date with the installed %s (%s), run "update-lock" again.',
+                        enve_lock_path, flatpak_extension['flatpak'], installed_commit or 'not installed')
+            return None
+
+    return enve_lock
+
+def find_enve_config(enve_options: dict) -> None:
+    '''Resolve the use-config option to the ENVE config path, prompting the user if no config can be found.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
 
     # If the enve_config file is not specified via the command line, first check to see if environment variable is set.
     if not enve_options['use-config'].value() and 'ENVE_CONFIG' in os.environ:
@@ -430,16 +1009,131 @@ def load_enve_config(enve_options: dict) -> dict:
         logger.error('ENVE config path does not exist: %s', enve_options['use-config'].value())
         exit(1)
 
+    # The installation option can be inherited from the environment, so resolve it before checking the lock
+    add_enve_flatpak_installation_variable({}, enve_options)
+
+def load_enve_config(enve_options: dict, is_export: bool=True, is_verified: bool=False) -> dict:
+    '''Add doc...'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    # We always spawn a new shell if we're loading an enve_config from an existing ENVE shell to ensure isolation of the
+    # requested command.
+    load_results = {'is_new_enve_shell_needed': 'ENVE_ID' in os.environ, 'config_imports': []}
+
+    with enve_profile.span('find_enve_config'):
+        find_enve_config(enve_options)
+
+    # Use the environment already resolved by the parent ENVE process if it was handed over.
+    with enve_profile.span('load_enve_snapshot'):
+        enve_snapshot = load_enve_snapshot(enve_options)
+    is_update = enve_options['update-install'].value() or enve_options['update-lock'].value()
+    with enve_profile.span('load_enve_lock'):
+        enve_lock = load_enve_lock(enve_options) if not (enve_snapshot or is_update) else None
+    if enve_snapshot:
+        enve_vars = enve_snapshot['enve_vars']
+        enve_delimiters = enve_snapshot['enve_delimiters']
+
+        load_results['config_imports'] = enve_vars['ENVE_CURRENT_CONFIG_FILES'].split('\n')[1:]
+        load_results['is_new_enve_shell_needed'] |= enve_snapshot.get('is_new_enve_shell_needed', False)
+
+        # The shell depth and prompt are the only variables that depend on the spawned environment
+        add_enve_shell_depth_variable(enve_vars, enve_options)
+        add_enve_prompt_variable(enve_vars, enve_options)
+        add_enve_config_stamp_variable(enve_vars)
+    elif enve_lock:
+        # The lock is up to date, so skip both the config evaluation and the extension verification.
+        logger.info('Using ENVE lock "%s".', get_enve_lock_path(enve_options['use-config'].value()))
+        enve_vars = enve_lock['enve_vars']
+        enve_delimiters = enve_lock['enve_delimiters']
+        load_results['config_imports'] = enve_lock['imports']
+
+        add_enve_shell_depth_variable(enve_vars, enve_options)
+        add_enve_prompt_variable(enve_vars, enve_options)
+        add_enve_config_stamp_variable(enve_vars)
+        add_enve_flatpak_installation_variable(enve_vars, enve_options)
+    else:
+        with enve_profile.span('resolve_enve_variables'):
+            enve_vars, enve_delimiters = resolve_enve_variables(enve_options, load_results, is_verified)
+
+    # Index the commands for the shell the variables are exported to, which only interactive shells read
+    if is_export and load_results['is_new_enve_shell_needed'] == False:
+        if is_enve_interactive_cmd(enve_options):
+            with enve_profile.span('add_enve_command_table_variable'):
+                add_enve_command_table_variable(enve_vars)
+        if enve_options['use-library-farm'].value():
+            with enve_profile.span('add_enve_library_farm_variable'):
+                add_enve_library_farm_variable(enve_vars)
+
+    load_results['enve_vars'] = enve_vars
+    load_results['enve_delimiters'] = enve_delimiters
+
+    if is_export:
+        export_variables(enve_vars, enve_delimiters, load_results['is_new_enve_shell_needed'])
+
+    logger.debug('Load Results:\n%s', DebugFormat(load_results))
+    return load_results
+
+def verify_extensions(enve_vars: dict, enve_options: dict, flatpak_extensions: list) -> dict:
+    '''Ensure all the flatpak extensions are installed with the right commit versions if specified, exiting if any
+    can't be. The missing and mismatched extensions are collected first so they can be fixed with as few flatpak
+    transactions as possible. Returns the inventory of the installation and whether anything was installed.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    for flatpak_extension in flatpak_extensions:
+        logger.info('Verifying Extension: %s', flatpak_extension['flatpak'])
+        logger.debug('%s:\n%s', flatpak_extension['flatpak'], DebugFormat(flatpak_extension))
+
+    # Snapshot the installation once, and verify all the extensions against it.
+    flatpak_inventory = load_flatpak_inventory(enve_options)
+
+    # Verify the extensions are installed, and attempt to install any not found
+    with enve_profile.span('extensions_verify_installed'):
+        verify_installed_results = \
+            extensions_verify_installed(enve_vars, enve_options, flatpak_extensions, flatpak_inventory)
+    if not verify_installed_results['is_installed']:
+        logger.error('ENVE load failed.')
+        exit(1)
+
+    # A new install changes the installation, so take a fresh snapshot for the commit verification
+    if verify_installed_results['is_new_install']:
+        flatpak_inventory = load_flatpak_inventory(enve_options)
+
+    # Verify the extension commits match the specified, and attempt to update any SHA mismatches
+    with enve_profile.span('extensions_verify_commit'):
+        verify_commit_results = \
+            extensions_verify_commit(enve_vars, enve_options, flatpak_extensions, flatpak_inventory)
+    if not verify_commit_results['is_installed']:
+        logger.error('ENVE load failed.')
+        exit(1)
+
+    return {'flatpak_inventory': flatpak_inventory,
+            'is_new_install': verify_installed_results['is_new_install'] or verify_commit_results['is_new_install']}
+
+def resolve_enve_variables(enve_options: dict, load_results: dict, is_verified: bool=False) -> [dict, dict]:
+    '''Evaluate the ENVE config and verify its extensions, unless is_verified, returning the ENVE variables and their
+    delimiters.'''
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
     # Jsonnet will validate the content for us and assert if anything is invalid.
     try:
-        enve_json = json.loads(_jsonnet.evaluate_file(
-            enve_options['use-config'].value(), import_callback=import_callback))['Enve']
+        with enve_profile.span('load_enve_json', config=enve_options['use-config'].value()):
+            enve_json, config_imports = load_enve_json(enve_options['use-config'].value())
     except Exception as err:
         logger.exception('Failed to load ENVE config "%s".', enve_options['use-config'].value())
         exit(1)
+    load_results['config_imports'] = config_imports
 
     # Load the ENVE variables
-    enve_vars = load_variables(enve_options, enve_json['id'], enve_json['variables'])
+    enve_delimiters = {}
+    with enve_profile.span('load_variables'):
+        enve_vars = load_variables(enve_options, enve_json['id'], enve_json['variables'], enve_delimiters,
+                                   config_imports)
 
     # Cannot update install when inside a currently active container
     if enve_options['update-install'].value() == True and 'ENVE_SHELL_DEPTH' in os.environ:
@@ -449,38 +1143,44 @@ def load_enve_config(enve_options: dict) -> dict:
     # Add the ENVE base extension to the front of the list of extensions
     enve_json['extensions'].insert(0, enve_json['base_extension_version'])
 
-    # Ensure all the specified flatpak extensions are installed with the right commit versions if specified.
-    for flatpak_extension in reversed(enve_json['extensions']):
-
-        # If the current environment config SHA matches the new config SHA, no need to verify as it's already been
-        # verified in a previous session.
-        if os.environ.get('ENVE_CURRENT_CONFIG_SHA_256', '') == enve_vars['ENVE_CURRENT_CONFIG_SHA_256']:
-            pass
-
-        # Otherwise, only verify the install if a new shell is needed or we're not inside a currently active container.
-        elif load_results['is_new_enve_shell_needed'] == True or 'ENVE_SHELL_DEPTH' not in os.environ:
-            logger.info('Verifying Extension: %s', flatpak_extension['flatpak'])
-            logger.debug('%s:\n%s', flatpak_extension['flatpak'],
-                         textwrap.indent(pprint.pformat(flatpak_extension), '  '))
-
-            # Verify the extension is installed, and attempt to install if not found
-            verify_installed_results = extension_verify_installed(enve_vars, enve_options, flatpak_extension)
-            load_results['is_new_enve_shell_needed'] |= verify_installed_results['is_new_install']
-            if not verify_installed_results['is_installed']:
-                logger.error('ENVE load failed.')
-                exit(1)
-
-            # Verify the extension commit matches the specified, and attempt to update if SHAs mismatch
-            verify_commit_results = extension_verify_commit(enve_vars, enve_options, flatpak_extension)
-            load_results['is_new_enve_shell_needed'] |= verify_commit_results['is_new_install']
-            if not verify_commit_results['is_installed']:
-                logger.error('ENVE load failed.')
-                exit(1)
+    # If the current environment config SHA matches the new config SHA, no need to verify as it's already been verified
+    # in a previous session. Otherwise, only verify the install if a new shell is needed or we're not inside a currently
+    # active container.
+    is_verify_needed = \
+        os.environ.get('ENVE_CURRENT_CONFIG_SHA_256', '') != enve_vars['ENVE_CURRENT_CONFIG_SHA_256'] and \
+        (load_results['is_new_enve_shell_needed'] == True or 'ENVE_SHELL_DEPTH' not in os.environ)
+
+    # Locking always verifies, as the installed commits are recorded in the lock
+    is_verify_needed |= enve_options['update-lock'].value()
+
+    # Matrix runs verify the extensions of all their configs together before loading them
+    is_verify_needed &= not is_verified
+
+    flatpak_inventory = {}
+    is_installation_changed = False
+    if is_verify_needed:
+        # The variables are only needed for the proxy settings while verifying
+        verify_results = verify_extensions(join_variables(enve_vars, enve_delimiters), enve_options,
+                                           list(reversed(enve_json['extensions'])))
+        flatpak_inventory = verify_results['flatpak_inventory']
+        is_installation_changed = verify_results['is_new_install']
+        load_results['is_new_enve_shell_needed'] |= is_installation_changed
 
+    for flatpak_extension in reversed(enve_json['extensions']):
         # Add the extension load directory paths to the load directories dictionary
-        add_variables(enve_vars, flatpak_extension['variables'], flatpak_extension['id_alias'],
+        add_variables(enve_vars, enve_delimiters, flatpak_extension['variables'], flatpak_extension['id_alias'],
                       flatpak_extension['path'])
 
+    # Drop the extension directories that don't exist, so they aren't searched on every command and library lookup. The
+    # directories are checked in the running sandbox, so nothing is dropped if extensions were just installed or
+    # updated, as they're only mounted in the new ENVE shell.
+    if enve_options['use-prune-paths'].value() and not is_installation_changed:
+        with enve_profile.span('load_path_index'):
+            path_index = load_path_index(enve_json['extensions'], get_flatpak_extension_commits())
+        prune_variables(enve_vars, enve_delimiters, path_index)
+
+    enve_vars = join_variables(enve_vars, enve_delimiters)
+
     if enve_options['update-install'].value() == True:
         enve_id_version = enve_vars['ENVE_ID']
         if 'ENVE_ID_VER' in enve_vars:
@@ -489,14 +1189,103 @@ def load_enve_config(enve_options: dict) -> dict:
         logger.info('%s update install successful.' % enve_id_version)
         exit(0)
 
-    export_variables(enve_vars, load_results['is_new_enve_shell_needed'])
+    if enve_options['update-lock'].value() == True:
+        # Any installs or updates changed the installation, so take a fresh snapshot of the installed commits
+        if is_installation_changed:
+            flatpak_inventory = load_flatpak_inventory(enve_options)
 
-    logger.debug('Load Results: %s' % load_results)
-    return load_results
+        enve_lock_path = write_enve_lock(enve_options, enve_vars, enve_delimiters, config_imports,
+                                         enve_json['extensions'], flatpak_inventory)
+        print('%s lock written to "%s".' % (enve_vars['ENVE_ID'], enve_lock_path))
+        logger.info('%s lock written to "%s".' % (enve_vars['ENVE_ID'], enve_lock_path))
+        exit(0)
 
-def load_cmd_metadata(cmd: list, enve_options: dict) -> configparser.ConfigParser:
+    return enve_vars, enve_delimiters
+
+def get_flatpak_installation_path(enve_options: dict) -> str:
+    '''The directory of the flatpak installation, if it can be seen from the sandbox, such as from a spawned ENVE shell
+    with host filesystem access. Returns None otherwise, or if more than one directory could be the installation.'''
+
+    import configparser
+    import glob
+
+    installation = enve_options['use-flatpak-installation'].value()
+    if installation == 'user':
+        # The host flatpak calls are passed FLATPAK_USER_DIR, which moves the user installation
+        installation_paths = [os.environ.get('FLATPAK_USER_DIR', ENVE_FLATPAK_USER_INSTALLATION_PATH)]
+    elif installation == 'system':
+        installation_paths = [ENVE_FLATPAK_SYSTEM_INSTALLATION_PATH]
+    else:
+        # Other installations are named in the host flatpak config
+        installation_paths = []
+        installation_conf_paths = glob.glob(os.path.join(ENVE_FLATPAK_INSTALLATIONS_CONF_PATH, '*.conf')) + \
+            glob.glob(os.path.join(ENVE_HOST_ROOT_PATH + ENVE_FLATPAK_INSTALLATIONS_CONF_PATH, '*.conf'))
+        for conf_path in installation_conf_paths:
+            installation_conf = configparser.ConfigParser()
+            try:
+                installation_conf.read(conf_path)
+            except configparser.Error:
+                continue
+            if installation_conf.has_option('Installation "%s"' % installation, 'Path'):
+                installation_paths.append(installation_conf['Installation "%s"' % installation]['Path'])
+
+    # The installation is only certain if a single directory is found, as the metadata and commits read from it have to
+    # match what the host flatpak calls see
+    host_installation_paths = []
+    for installation_path in installation_paths:
+        for host_installation_path in [installation_path, ENVE_HOST_ROOT_PATH + installation_path]:
+            if os.path.isdir(os.path.join(host_installation_path, 'repo')) and \
+               not any(os.path.samefile(host_installation_path, found_path) for found_path in host_installation_paths):
+                host_installation_paths.append(host_installation_path)
+
+    return host_installation_paths[0] if len(host_installation_paths) == 1 else None
+
+def get_flatpak_app_deploy(enve_options: dict, app_id: str) -> dict:
+    '''The ref and active commit of the deployed flatpak app, along with the installation's change marker, read from the
+    installation directory without querying the host. Returns None if the deploy can't be seen from the sandbox.'''
+
+    installation_path = get_flatpak_installation_path(enve_options)
+    if installation_path is None:
+        return None
+
+    try:
+        # Flatpak touches the .changed marker whenever it changes the installation. It's read before the deploy so an
+        # update racing with us moves the marker past what we record.
+        changed = os.stat(os.path.join(installation_path, '.changed')).st_mtime_ns
+        # The current link points at the arch/branch deployed, and its active link at the commit
+        app_path = os.path.join(installation_path, 'app', app_id)
+        return {'ref': 'app/%s/%s' % (app_id, os.readlink(os.path.join(app_path, 'current'))),
+                'commit': os.readlink(os.path.join(app_path, 'current', 'active')),
+                'changed': changed}
+    except OSError:
+        return None
+
+def get_installed_extension_commits(enve_options: dict, flatpak_refs: list) -> dict:
+    '''The commit deployed for each of the extension refs, or None for refs that aren't installed. The commits are read
+    from the deploy links of the installation if it can be seen from the sandbox, and otherwise from a snapshot of the
+    installation.'''
+
+    installation_path = get_flatpak_installation_path(enve_options)
+    if installation_path is None:
+        flatpak_inventory = load_flatpak_inventory(enve_options)
+        return {flatpak_ref: flatpak_inventory.get(flatpak_ref, {}).get('commit') for flatpak_ref in flatpak_refs}
+
+    installed_commits = {}
+    for flatpak_ref in flatpak_refs:
+        try:
+            # Extensions are deployed as runtimes, with the active link pointing at the commit
+            installed_commits[flatpak_ref] = \
+                os.readlink(os.path.join(installation_path, 'runtime', flatpak_ref, 'active'))
+        except OSError:
+            installed_commits[flatpak_ref] = None
+
+    return installed_commits
+
+def load_cmd_metadata(cmd: list, enve_options: dict) -> 'configparser.ConfigParser':
     '''Add doc...'''
 
+    import configparser
+
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
@@ -504,9 +1293,29 @@ def load_cmd_metadata(cmd: list, enve_options: dict) -> configparser.ConfigParse
 
     # Metadata only exists if the command is a flatpak app
     if re.match('\w+\.\w+\.\w+', cmd[0]):
-        # Attempt to get the flatpak metadata information
-        flatpak_spawn_cmd_args = get_flatpak_cmd(enve_options, ['info', '--show-metadata', cmd[0]])
-        completed_output = subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args), capture_output=True, text=True)
+        # The metadata only changes with the deployed commit, so it's cached by ref and commit for as long as the
+        # installation is unchanged
+        metadata_cache = enve_cache.EnveCache('metadata')
+        app_deploy = get_flatpak_app_deploy(enve_options, cmd[0])
+        cache_entry = None
+        if app_deploy:
+            cache_key = '%s\n%s\n%s' % (enve_options['use-flatpak-installation'].value(), app_deploy['ref'],
+                                        app_deploy['commit'])
+            cache_entry = metadata_cache.get(cache_key, is_valid=lambda cache_entry: \
+                                             cache_entry['changed'] == app_deploy['changed'])
+            logger.debug('Flatpak metadata cache %s for %s commit %s', 'hit' if cache_entry else 'miss',
+                         app_deploy['ref'], app_deploy['commit'])
+
+        if cache_entry:
+            completed_output = subprocess.CompletedProcess([], 0, stdout=cache_entry['metadata'])
+        else:
+            # Attempt to get the flatpak metadata information
+            flatpak_spawn_cmd_args = get_flatpak_cmd(enve_options, ['info', '--show-metadata', cmd[0]])
+            with enve_profile.span('flatpak info', app=cmd[0]):
+                completed_output = subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args), capture_output=True,
+                                                  text=True)
+            if completed_output.returncode == 0 and app_deploy:
+                metadata_cache.put(cache_key, {'changed': app_deploy['changed'], 'metadata': completed_output.stdout})
 
         # If we're successful with getting the flatpak metadata information, then proceed with running the flatpak app
         # using flatpak-spawn.
@@ -523,25 +1332,303 @@ def load_cmd_metadata(cmd: list, enve_options: dict) -> configparser.ConfigParse
 
     return cmd_metadata
 
+def get_enve_daemon_socket_path(enve_options: dict) -> str:
+    '''A daemon serves a single config and flatpak installation.'''
+
+    import enve_daemon
+
+    return enve_daemon.get_socket_path('%s\n%s' % (os.path.abspath(enve_options['use-config'].value()),
+                                                   enve_options['use-flatpak-installation'].value()))
+
+def is_enve_daemon_cmd(cmd: list, enve_options: dict) -> bool:
+    '''The daemon only runs plain non-interactive commands. Flatpak apps, interactive commands and anything needing a
+    new ENVE shell, an update, a batch or a matrix are run by loading the config as usual.'''
+
+    return enve_options['use-interactive'].was_passed() and not enve_options['use-interactive'].value() and \
+        not enve_options['use-debug-shell'].value() and \
+        not (enve_options['run-batch'].value() or enve_options['run-matrix'].value()) and \
+        not (enve_options['update-install'].value() or enve_options['update-lock'].value()) and \
+        'ENVE_ID' not in os.environ and not re.match('\w+\.\w+\.\w+', cmd[0])
+
+def get_enve_config_stat(config_paths: list) -> list:
+    '''The mtime and size of the config files, used to notice when a loaded config is out of date.'''
+
+    config_stat = []
+    for config_path in config_paths:
+        try:
+            path_stat = os.stat(config_path)
+            config_stat.append([config_path, path_stat.st_mtime_ns, path_stat.st_size])
+        except OSError:
+            config_stat.append([config_path, None, None])
+
+    return config_stat
+
+def run_enve_batch(enve_options: dict) -> None:
+    '''Run the batch of commands in the environment exported by load_enve_config, then print the exit status, timing
+    and output of every command as JSON and exit with the status of the first command that failed.'''
+
+    import enve_batch
+    import time
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    try:
+        batch_cmds = enve_batch.read_commands(enve_options['run-batch'].value())
+    except OSError as err:
+        logger.error('Unable to read ENVE batch "%s": %s', enve_options['run-batch'].value(), err)
+        exit(1)
+
+    def log_result(result: dict) -> None:
+        logger.info('Batch command %d %s (%d) in %.3fs: %s', result['index'] + 1,
+                    'passed' if result['returncode'] == 0 else 'failed', result['returncode'], result['seconds'],
+                    result['cmd'])
+
+    with enve_profile.span('run batch', commands=len(batch_cmds), jobs=enve_options['use-batch-jobs'].value()):
+        batch_start = time.perf_counter()
+        results = enve_batch.run_batch(batch_cmds, enve_options['use-batch-jobs'].value(), ENVE_RUN_CMD, log_result)
+        batch_seconds = time.perf_counter() - batch_start
+
+    returncode = enve_batch.get_returncode(results)
+    click.echo(json.dumps({'returncode': returncode, 'seconds': round(batch_seconds, 6), 'results': results}, indent=2))
+    exit(returncode)
+
+def get_matrix_waves(enve_matrix: list) -> list:
+    '''Group the matrix configs into waves, as only one commit of an extension can be installed at a time. A config
+    joins the first wave none of whose configs pin its extensions to other commits. Returns the waves in order as
+    (config indexes, extensions) tuples, the extensions being the union of those of the wave's configs, where an
+    extension pinned to a commit by one config takes that commit over a config using whatever is installed.'''
+
+    def is_conflicting(wave_extensions: dict, flatpak_extension: dict) -> bool:
+        wave_commit = wave_extensions.get(flatpak_extension['flatpak'], flatpak_extension)['commit']
+        return 'current_installed' not in [wave_commit, flatpak_extension['commit']] and \
+            wave_commit != flatpak_extension['commit']
+
+    matrix_waves = []
+    for config_index, (_, enve_json) in enumerate(enve_matrix):
+        config_extensions = [enve_json['base_extension_version']] + enve_json['extensions']
+        config_wave = None
+        for matrix_wave in matrix_waves:
+            if not any(is_conflicting(matrix_wave[1], flatpak_extension) for flatpak_extension in config_extensions):
+                config_wave = matrix_wave
+                break
+        if config_wave is None:
+            config_wave = ([], collections.OrderedDict())
+            matrix_waves.append(config_wave)
+
+        config_wave[0].append(config_index)
+        for flatpak_extension in config_extensions:
+            wave_extension = config_wave[1].setdefault(flatpak_extension['flatpak'], flatpak_extension)
+            if wave_extension['commit'] == 'current_installed':
+                config_wave[1][flatpak_extension['flatpak']] = flatpak_extension
+
+    return [(config_indexes, list(wave_extensions.values())) for config_indexes, wave_extensions in matrix_waves]
+
+def run_enve_matrix(cmd: list, enve_options: dict) -> None:
+    '''Run the command in the environment of every config in run-matrix, each in its own ENVE process. The configs are
+    evaluated up front and run in waves of configs whose extension commits agree, the extensions of each wave being
+    verified together before its configs run. Each ENVE process is handed its resolved environment, so the configs are
+    only loaded once.'''
+
+    import enve_batch
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    if enve_options['update-install'].value() or enve_options['update-lock'].value():
+        logger.error('ENVE "run-matrix" cannot update the install or lock, update each config on its own.')
+        exit(1)
+
+    # Evaluate every config in this process
+    matrix_options = []
+    matrix_vars = []
+    enve_matrix = []
+    for config_path in [config_path for config_path in enve_options['run-matrix'].value().split(':') if config_path]:
+        config_options = copy.deepcopy(enve_options)
+        config_options['use-config'].update_value(config_path, was_passed=True)
+        find_enve_config(config_options)
+        try:
+            with enve_profile.span('load_enve_json', config=config_options['use-config'].value()):
+                enve_json, config_imports = load_enve_json(config_options['use-config'].value())
+        except Exception as err:
+            logger.exception('Failed to load ENVE config "%s".', config_options['use-config'].value())
+            exit(1)
+        # The variables are only needed for the proxy settings while verifying
+        enve_delimiters = {}
+        matrix_vars.append(join_variables(load_variables(config_options, enve_json['id'], enve_json['variables'],
+                                                         enve_delimiters, config_imports), enve_delimiters))
+        matrix_options.append(config_options)
+        enve_matrix.append((config_options['use-config'].value(), enve_json))
+
+    def log_result(result: dict) -> None:
+        logger.info('Matrix config %s (%d) in %.3fs: %s', 'passed' if result['returncode'] == 0 else 'failed',
+                    result['returncode'], result['seconds'], result['cmd'])
+
+    results = [None] * len(enve_matrix)
+    matrix_waves = get_matrix_waves(enve_matrix)
+    for wave_number, (config_indexes, wave_extensions) in enumerate(matrix_waves, 1):
+        if len(matrix_waves) > 1:
+            logger.info('ENVE matrix wave %d of %d: %s', wave_number, len(matrix_waves),
+                        ', '.join(enve_matrix[config_index][0] for config_index in config_indexes))
+
+        # One inventory check and install pass for the extensions of all the configs of the wave, with the proxy
+        # settings of any of them
+        wave_vars = {}
+        for config_index in config_indexes:
+            wave_vars.update(matrix_vars[config_index])
+        verify_results = verify_extensions(wave_vars, enve_options, wave_extensions)
+
+        # Resolve the environment of each config, handed to its ENVE process so it doesn't load the config again
+        jobs = []
+        for config_index in config_indexes:
+            config_options = matrix_options[config_index]
+            with enve_profile.span('load_enve_config', config=config_options['use-config'].value()):
+                load_results = load_enve_config(config_options, is_export=False, is_verified=True)
+
+            config_environ = dict(os.environ, **enve_profile.get_environ())
+            # Extensions installed by the verification are only mounted in a new ENVE shell
+            enve_snapshot = dump_enve_snapshot(config_options, load_results, verify_results['is_new_install'])
+            if enve_snapshot:
+                config_environ['ENVE_SNAPSHOT'] = enve_snapshot
+
+            # The config's ENVE process runs the command on its own
+            config_cmd = [ENVE_PY_PATH]
+            for option in config_options:
+                if config_options[option].was_passed() and \
+                   option not in ['run-matrix', 'use-batch-jobs', 'use-interactive']:
+                    config_cmd += ['--ENVE', str(option), str(config_options[option].value())]
+            config_cmd += ['--ENVE', 'use-interactive', 'f'] + cmd
+
+            jobs.append((config_options['use-config'].value(), config_cmd, config_environ))
+
+        with enve_profile.span('run matrix', wave=wave_number, configs=len(jobs),
+                               jobs=enve_options['use-batch-jobs'].value()):
+            # Every config of the wave runs at once unless limited
+            wave_results = enve_batch.run_jobs(jobs, enve_options['use-batch-jobs'].value() or len(jobs), log_result)
+        for config_index, result in zip(config_indexes, wave_results):
+            results[config_index] = result
+
+    for result in results:
+        click.echo('==> %s <==\n%s' % (result['cmd'], result['output']), nl=not result['output'].endswith('\n'))
+    click.echo(enve_batch.format_table(results, 'CONFIG'))
+    exit(enve_batch.get_returncode(results))
+
+def run_enve_daemon(enve_options: dict) -> None:
+    '''Serve non-interactive commands for the config over a Unix socket, keeping the loaded config in memory. The config
+    is loaded again whenever it or any of its imports change.'''
+
+    import enve_daemon
+    import threading
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    find_enve_config(enve_options)
+    socket_path = get_enve_daemon_socket_path(enve_options)
+    state_lock = threading.Lock()
+    state = {}
+
+    def load_state() -> None:
+        state.clear()
+        load_results = load_enve_config(enve_options, is_export=False)
+
+        # Extensions installed since this process started aren't mounted in its sandbox
+        if load_results['is_new_enve_shell_needed']:
+            logger.warning('ENVE daemon needs a new ENVE shell for "%s", restart the daemon.',
+                           enve_options['use-config'].value())
+            return
+
+        state.update(load_results)
+        state['config_stat'] = get_enve_config_stat([os.path.abspath(enve_options['use-config'].value())] +
+                                                    load_results['config_imports'])
+        logger.info('ENVE daemon loaded "%s".', enve_options['use-config'].value())
+
+    def handle_request(request: dict, fds: list) -> 'subprocess.Popen':
+        with state_lock:
+            if not state or state['config_stat'] != get_enve_config_stat([path for path, _, _ in
+                                                                          state['config_stat']]):
+                try:
+                    load_state()
+                except SystemExit:
+                    state.clear()
+            if not state:
+                return None
+            enve_vars = dict(state['enve_vars'])
+            enve_delimiters = state['enve_delimiters']
+
+        logger.info('ENVE daemon running "%s" in "%s".', ' '.join(request['cmd']), request['cwd'])
+        enve_vars['ENVE_SHELL_DEPTH'] = request['environ'].get('ENVE_SHELL_DEPTH', '0')
+        environ = dict(request['environ'])
+        environ.update(merge_environ_variables(enve_vars, enve_delimiters, request['environ']))
+
+        try:
+            # The command leads its own process group, which is sent the signals relayed by the client
+            return subprocess.Popen([*ENVE_RUN_CMD, ' '.join(request['cmd'])], stdin=fds[0], stdout=fds[1],
+                                    stderr=fds[2], cwd=request['cwd'], env=environ,
+                                    preexec_fn=enve_daemon.start_process_group)
+        except OSError as err:
+            logger.warning('ENVE daemon failed to run "%s": %s', ' '.join(request['cmd']), err)
+            return None
+
+    load_state()
+
+    # Stop serving on SIGTERM the same as on an interrupt, so the socket is removed
+    import signal
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        enve_daemon.EnveDaemon(socket_path, handle_request).serve_forever(
+            on_listen=lambda: print('ENVE daemon serving "%s" on "%s".' % (enve_options['use-config'].value(),
+                                                                           socket_path), flush=True))
+    except FileExistsError as err:
+        logger.error('%s', err)
+        exit(1)
+    except KeyboardInterrupt:
+        pass
+    exit(0)
+
 def run_cmd(cmd: list, enve_options: dict) -> None:
     '''Add doc...'''
 
     # Get the logger instance
     logger = logging.getLogger(__name__)
 
+    if enve_options['run-daemon'].value():
+        run_enve_daemon(enve_options)
+
+    # Hand plain commands to the daemon for the config if one is serving
+    if enve_options['use-daemon'].value() and is_enve_daemon_cmd(cmd, enve_options):
+        import enve_daemon
+
+        find_enve_config(enve_options)
+        socket_path = get_enve_daemon_socket_path(enve_options)
+        try:
+            returncode = enve_daemon.request(socket_path, cmd, os.getcwd(), os.environ)
+        except ConnectionError as err:
+            # The command may already have run, so it isn't run again by loading the config
+            logger.error('ENVE daemon on "%s" stopped while running "%s": %s', socket_path, ' '.join(cmd), err)
+            exit(1)
+        if returncode is not None:
+            exit(returncode)
+        logger.debug('No ENVE daemon serving on "%s"', socket_path)
+
+    if enve_options['run-matrix'].value():
+        run_enve_matrix(cmd, enve_options)
+
     # Load the ENVE config
     load_results = load_enve_config(enve_options)
 
     # Load the command meta data if the command is a flatpak app. If the command is not a flatpak app,
     # cmd_metadata.sections() will be [], indicating nothing was loaded or found for the supplied command.
-    cmd_metadata = load_cmd_metadata(cmd, enve_options)
+    with enve_profile.span('load_cmd_metadata'):
+        cmd_metadata = load_cmd_metadata(cmd, enve_options)
 
     # Use flatpak-spawn if a new enve shell is needed for the config
     if cmd_metadata.sections() != [] or load_results['is_new_enve_shell_needed'] == True:
 
         # If we weren't passed a flatpak app as a command, grab the command meta data from the current flatpak ID.
         if not cmd_metadata.sections():
-            cmd_metadata = load_cmd_metadata([os.environ['FLATPAK_ID']], enve_options)
+            with enve_profile.span('load_cmd_metadata'):
+                cmd_metadata = load_cmd_metadata([os.environ['FLATPAK_ID']], enve_options)
             # Use the flatpak app as the primary command, and supply the desired command as the argument to pass into
             # enve.py when the new environment is spawned.
             cmd.insert(0, os.environ['FLATPAK_ID'])
@@ -578,18 +1665,33 @@ def run_cmd(cmd: list, enve_options: dict) -> None:
              '--share=network',
              '--device=all',
              '--env=ENVE_SHELL_DEPTH=%s' % str(int(os.environ.get('ENVE_SHELL_DEPTH', '0')) + 1),
-             '--env=TERM=%s' % os.environ.get('TERM', '')] + cmd
+             '--env=TERM=%s' % os.environ.get('TERM', '')]
+
+        # Hand the resolved environment over so the spawned ENVE doesn't have to load the config again
+        enve_snapshot = dump_enve_snapshot(enve_options, load_results)
+        if enve_snapshot:
+            flatpak_cmd_args += ['--env=ENVE_SNAPSHOT=%s' % enve_snapshot]
+
+        # The spawned ENVE adds its spans to the same trace
+        flatpak_cmd_args += ['--env=%s=%s' % item for item in enve_profile.get_environ().items()]
+
+        flatpak_cmd_args += cmd
         flatpak_spawn_cmd_args = ['--watch-bus'] + get_flatpak_cmd(enve_options, flatpak_cmd_args)
 
         # Run the command to completion
-        exit(subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode)
+        with enve_profile.span('flatpak run', runtime=cmd_metadata['Application']['sdk']):
+            returncode = subprocess.run(get_flatpak_spawn_cmd(flatpak_spawn_cmd_args)).returncode
+        exit(returncode)
+
+    if enve_options['run-batch'].value():
+        run_enve_batch(enve_options)
 
     cmd_str = ' '.join(cmd)
 
     if (not enve_options['use-debug-shell'].value()) or click.confirm('Debug shell enabled. Run command "%s"?' % cmd_str):
 
         # Run the command to completion
-        logger.debug('Run Command:\n%s', textwrap.indent(pprint.pformat(cmd), '  '))
+        logger.debug('Run Command:\n%s', DebugFormat(cmd))
 
         # If the use-interactive flag was not specified, it means we've been invoked directly from the host system using
         # flatpak run (as opposed to flatpak-spawn which will always pass the use-interactive flag). We'll default to
@@ -597,17 +1699,30 @@ def run_cmd(cmd: list, enve_options: dict) -> None:
         # prevalent case will be calls from a host IDE, for which we expect the use-interactive flag to be passed if
         # necessary and set appropriately.
         if (not enve_options['use-interactive'].was_passed()) or enve_options['use-interactive'].value():
+            import enve_motd
+            import psutil
+            import pty2
+
             if cmd_str in ['sh', 'bash']:
-                enve_motd.print_enve_motd()
-            if psutil.Process().terminal() == None:
-                # Can't be interactive without a PTY, so create one if it doesn't exist
-                errno = pty2.wspawn([*ENVE_RUN_INTERACTIVE_CMD, cmd_str])
-            else:
-                errno = subprocess.run([*ENVE_RUN_INTERACTIVE_CMD, cmd_str]).returncode
+                with enve_profile.span('print_enve_motd'):
+                    enve_motd.print_enve_motd()
+            with enve_profile.span('run command', cmd=cmd_str):
+                if psutil.Process().terminal() == None:
+                    # Can't be interactive without a PTY, so create one if it doesn't exist
+                    errno = pty2.wspawn([*ENVE_RUN_INTERACTIVE_CMD, cmd_str])
+                else:
+                    errno = subprocess.run([*ENVE_RUN_INTERACTIVE_CMD, cmd_str]).returncode
+        elif enve_options['use-exec'].value() and not enve_options['use-debug-shell'].value():
+            exec_cmd(cmd)
         else:
-            errno = subprocess.run([*ENVE_RUN_CMD, cmd_str]).returncode
+            with enve_profile.span('run command', cmd=cmd_str):
+                errno = subprocess.run([*ENVE_RUN_CMD, cmd_str]).returncode
 
     if enve_options['use-debug-shell'].value():
+        import enve_motd
+        import psutil
+        import pty2
+
         enve_motd.print_enve_motd()
         if psutil.Process().terminal() == None:
             errno = pty2.wspawn([*ENVE_RUN_INTERACTIVE_CMD, 'sh'])
@@ -616,6 +1731,28 @@ def run_cmd(cmd: list, enve_options: dict) -> None:
 
     exit(errno)
 
+def exec_cmd(cmd: list) -> None:
+    '''Replace the ENVE process with the command, run with its argv as given and the exported environment. Only returns
+    by exiting if the command can't be run.'''
+
+    import sys
+
+    # Get the logger instance
+    logger = logging.getLogger(__name__)
+
+    # Nothing runs at exit once the process is replaced, so write out the profile and any buffered output first
+    enve_profile.write()
+    logging.shutdown()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        os.execvpe(cmd[0], cmd, os.environ)
+    except OSError as e:
+        # Exit the same as the shell would for a command not found or not executable
+        logger.error('Unable to run command "%s": %s', cmd[0], e.strerror)
+        exit(127 if isinstance(e, FileNotFoundError) else 126)
+
 def enve_default_options() -> dict:
     '''Add doc...'''
 
@@ -695,6 +1832,71 @@ ENVE_OPTIONS = (
                '''Add doc.'''
     ),
 
+    EnveOption('update-lock', False, click.BOOL,
+               '''Verify the extensions, then write a lockfile next to the config pinning the installed commit of every
+               extension and the fully expanded variables. While the lockfile is newer than the config and its
+               imports, it is loaded instead of evaluating the config and verifying the extensions.'''
+    ),
+
+    EnveOption('use-prune-paths', False, click.BOOL,
+               '''Leave the extension directories that don't exist, such as a declared lib directory an extension
+               doesn't ship, out of the exported variables (PATH, LD_LIBRARY_PATH, ...). Which directories exist is
+               recorded once per extension commit. The ENVE_ variables of the extensions keep every declared
+               directory.'''
+    ),
+
+    EnveOption('use-library-farm', False, click.BOOL,
+               '''Link the libraries of the read-only library directories in the exported LD_LIBRARY_PATH, such as the
+               extension lib directories, into a single directory used in their place. The dynamic linker then finds a
+               library with one probe instead of trying each directory in turn. The directory is kept in the ENVE cache
+               and reused while the extension commits are unchanged. Libraries locating files relative to $ORIGIN see
+               the linked directory as their origin.'''
+    ),
+
+    EnveOption('use-profile', '', click.Path(dir_okay=False, writable=True, resolve_path=True),
+               '''Record how long each phase of loading the config and running the command takes, and write it to the
+               given file in the Chrome trace event format (chrome://tracing, Perfetto). The spans of spawned ENVE
+               processes are written to the same trace, one at a time through a lock file next to it.'''
+    ),
+
+    EnveOption('use-exec', False, click.BOOL,
+               '''Run non-interactive commands (use-interactive f) by replacing the ENVE process with the command,
+               instead of running it through a shell. The command's arguments are passed as given, so they aren't split
+               or expanded by a shell.'''
+    ),
+
+    EnveOption('run-batch', '', click.STRING,
+               '''Load the config once, then run the commands read from the given file, or stdin if "-", one shell
+               command per line. Blank lines and lines starting with "#" are skipped. The exit status, start and run
+               time and the combined stdout and stderr of every command are printed as JSON, and ENVE exits with the
+               status of the first command that failed.'''
+    ),
+
+    EnveOption('run-matrix', '', click.STRING,
+               '''Run the command in the environment of each of the given configs, separated by ":", in parallel. The
+               configs are evaluated first, then run in waves, each config in its own ENVE process. Configs pinning an
+               extension to different commits run in separate waves, one after the other, as only one commit of an
+               extension can be installed at a time. The extensions of each wave are verified, and installed or updated
+               to its commits, together before its configs run. The output of every config is printed once all have
+               finished, followed by a table of the results, and ENVE exits with the status of the first config that
+               failed.'''
+    ),
+
+    EnveOption('use-batch-jobs', 0, click.IntRange(min=0),
+               '''Number of run-batch commands run at once. Defaults to the number of CPUs. Also limits the number of
+               run-matrix configs run at once, which otherwise all run together.'''
+    ),
+
+    EnveOption('use-daemon', False, click.BOOL,
+               '''Run non-interactive commands (use-interactive f) through the ENVE daemon serving the config, if one is
+               running, which skips loading the config. Falls back to loading the config if no daemon is serving.'''
+    ),
+
+    EnveOption('run-daemon', False, click.BOOL,
+               '''Load the config, then keep serving commands for it from memory until interrupted. The config is loaded
+               again whenever it or any of its imports change.'''
+    ),
+
     # EnveOption('use-sandbox', False, click.BOOL,
     #            '''Add doc.'''
     # )
@@ -728,6 +1930,9 @@ def cli(ctx, cmd: tuple, enve: tuple) -> None:
     # Convert the cmd tuple into a list
     cmd = list(cmd)
 
+    if enve_options['use-profile'].value():
+        enve_profile.start(enve_options['use-profile'].value(), 'enve %s' % ' '.join(cmd))
+
     # If no command is specified, start the shell by default
     if not cmd:
         cmd = ['sh']
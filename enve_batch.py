@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import subprocess
+
+def read_commands(batch_path: str) -> list:
+    '''Read the batch commands, one shell command per line, from batch_path, or stdin if it is "-". Blank lines and
+    lines starting with "#" are skipped.'''
+
+    if batch_path == '-':
+        batch_lines = sys.stdin.read().splitlines()
+    else:
+        with open(batch_path) as batch_file:
+            batch_lines = batch_file.read().splitlines()
+
+    return [batch_line.strip() for batch_line in batch_lines \
+            if batch_line.strip() and not batch_line.strip().startswith('#')]
+
+def run_job(index: int, name: str, argv: list, env: dict, batch_start: float) -> dict:
+    '''Run argv with env, or the current environment if None, capturing its stdout and stderr together as they
+    interleave. A command that can't be started fails the same as the shell would for a command not found or not
+    executable, with the error as its output.'''
+
+    start = time.perf_counter()
+    try:
+        completed_output = subprocess.run(argv, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT)
+        returncode = completed_output.returncode
+        output = completed_output.stdout.decode(errors='replace')
+    except OSError as err:
+        returncode = 127 if isinstance(err, FileNotFoundError) else 126
+        output = 'Unable to run "%s": %s\n' % (argv[0], err.strerror or err)
+
+    return {'index': index,
+            'cmd': name,
+            'returncode': returncode,
+            'start': round(start - batch_start, 6),
+            'seconds': round(time.perf_counter() - start, 6),
+            'output': output}
+
+def run_jobs(jobs: list, max_jobs: int, on_result=None) -> list:
+    '''Run the jobs, each a (name, argv, env) tuple, with up to max_jobs of them at once. on_result is called with each
+    result as its job finishes. Returns the results in the order of jobs.'''
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    batch_start = time.perf_counter()
+    results = [None] * len(jobs)
+    # The workers only wait on their job, so threads are enough to keep max_jobs jobs running
+    with ThreadPoolExecutor(max_workers=max_jobs or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(run_job, index, name, argv, env, batch_start) \
+                   for index, (name, argv, env) in enumerate(jobs)]
+        for future in as_completed(futures):
+            result = future.result()
+            results[result['index']] = result
+            if on_result:
+                on_result(result)
+
+    return results
+
+def run_batch(cmds: list, max_jobs: int, shell_cmd: tuple, on_result=None) -> list:
+    '''Run the commands with shell_cmd in the current environment, with up to max_jobs of them at once. Returns the
+    results in the order of cmds.'''
+
+    return run_jobs([(cmd, [*shell_cmd, cmd], None) for cmd in cmds], max_jobs, on_result)
+
+def get_returncode(results: list) -> int:
+    '''The exit status of the batch, that of the first command in the batch that failed, or 0 if none failed.'''
+
+    for result in results:
+        if result['returncode'] != 0:
+            # Commands killed by a signal have a negative return code, which isn't a valid exit status
+            return result['returncode'] if result['returncode'] > 0 else 128 - result['returncode']
+
+    return 0
+
+def format_table(results: list, name_heading: str) -> str:
+    '''Format the results as a table of name, status, exit status and run time, one row per result.'''
+
+    rows = [(name_heading, 'STATUS', 'EXIT', 'SECONDS')] + \
+           [(result['cmd'], 'passed' if result['returncode'] == 0 else 'failed', str(result['returncode']),
+             '%.3f' % result['seconds']) for result in results]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+
+    return '\n'.join('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import hashlib
+
+ENVE_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                               'enve')
+
+def sha256_lines(path_digests: list) -> str:
+    '''Combine (path, sha256) pairs into a single fingerprint. The lines hashed match the output of sha256sum, so the
+    same fingerprint can be recomputed with "sha256sum FILE... | sha256sum".'''
+
+    fingerprint = hashlib.sha256()
+    for path, digest in path_digests:
+        fingerprint.update(('%s  %s\n' % (digest, path)).encode())
+
+    return fingerprint.hexdigest()
+
+# Files modified this recently may still be changing within the same mtime, so their digests aren't memoized
+DIGEST_SETTLE_NS = 2 * 10**9
+
+# The most file digests memoized, the least recently digested are dropped past it
+DIGEST_MAX_FILES = 1024
+
+# The file digests memoized by files_sha256, loaded from the digests cache on first use
+_file_digests = None
+
+def file_sha256(path: str) -> str:
+    '''The SHA-256 of the file content. The digest is memoized along with the file mtime, size and inode, so the file
+    is only read again once it changes. The digests of files that no longer exist are dropped whenever the memo is
+    saved.'''
+
+    global _file_digests
+    if _file_digests is None:
+        _file_digests = EnveCache('digests').get('files') or {}
+
+    path_stat = os.stat(path)
+    file_stat = [path_stat.st_mtime_ns, path_stat.st_size, path_stat.st_ino]
+    if _file_digests.get(path, [])[:3] == file_stat:
+        return _file_digests[path][3]
+
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+
+    if time.time_ns() - path_stat.st_mtime_ns > DIGEST_SETTLE_NS:
+        # Digested again, so moved to the most recent end
+        _file_digests.pop(path, None)
+        _file_digests[path] = file_stat + [digest]
+        for digest_path in [digest_path for digest_path in _file_digests if not os.path.exists(digest_path)] + \
+                           list(_file_digests)[:-DIGEST_MAX_FILES]:
+            _file_digests.pop(digest_path, None)
+        EnveCache('digests').put('files', _file_digests)
+
+    return digest
+
+def files_sha256(paths: list) -> str:
+    '''Fingerprint the content of the given files. Returns None if any of the files can not be read.'''
+
+    path_digests = []
+    for path in paths:
+        try:
+            path_digests.append((path, file_sha256(path)))
+        except OSError:
+            return None
+
+    return sha256_lines(path_digests)
+
+class EnveCache:
+    '''A directory of JSON cache entries bounded by entry count and total size. Entries are evicted least recently
+    used first, using the entry file mtime as the access time. The hit/miss counters are kept in memory, unless
+    is_stats_persisted, in which case they're counted across runs in the cache's stats.json at the cost of a write per
+    lookup.'''
+
+    def __init__(self, name: str, max_entries: int=64, max_bytes: int=32 * 1024 * 1024,
+                 is_stats_persisted: bool=False):
+        self._name = name
+        self._path = os.path.join(ENVE_CACHE_PATH, name)
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._is_stats_persisted = is_stats_persisted
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def path(self) -> str:
+        return self._path
+
+    def stats(self) -> dict:
+        '''The hit/miss counters as of the last lookup.'''
+        return self._stats
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self._path, hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+    def get(self, key: str, is_valid=None):
+        '''Return the cached value for key, or None on a miss. If is_valid is given, a cached value it rejects is
+        counted as a miss.'''
+
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path) as entry_file:
+                value = json.load(entry_file)
+        except (OSError, ValueError):
+            value = None
+
+        if value is not None and is_valid is not None and not is_valid(value):
+            value = None
+
+        if value is not None:
+            try:
+                # Touch the entry so eviction sees it as recently used
+                os.utime(entry_path)
+            except OSError:
+                pass
+
+        self._update_stats(value is not None)
+
+        return value
+
+    def put(self, key: str, value) -> bool:
+        '''Store value for key, then evict entries beyond the cache bounds. Returns False if the entry could not be
+        written.'''
+
+        import tempfile
+
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            # Write to a temporary file first so concurrent readers never see a partial entry
+            entry_fd, entry_tmp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+            with os.fdopen(entry_fd, 'w') as entry_file:
+                json.dump(value, entry_file)
+            os.replace(entry_tmp_path, self.entry_path(key))
+        except OSError:
+            return False
+
+        self.evict()
+        return True
+
+    def evict(self) -> None:
+        '''Remove the least recently used entries until the cache is within its bounds. Other files and directories
+        kept in the cache directory, such as the command tables and library farms, are evicted along with the entries,
+        so their users have to touch them whenever they're used. A directory is sized by its own size, which grows with
+        the number of files in it.'''
+
+        import shutil
+
+        entries = []
+        try:
+            with os.scandir(self._path) as dir_entries:
+                for dir_entry in dir_entries:
+                    # Temporary files and directories are entries still being written
+                    if dir_entry.name != 'stats.json' and not dir_entry.name.endswith('.tmp') and \
+                       not dir_entry.is_symlink():
+                        entry_stat = dir_entry.stat(follow_symlinks=False)
+                        entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, dir_entry.path))
+        except OSError:
+            return
+
+        entries.sort(reverse=True)
+        total_bytes = 0
+        for index, (_, entry_size, entry_path) in enumerate(entries):
+            total_bytes += entry_size
+            if index >= self._max_entries or total_bytes > self._max_bytes:
+                try:
+                    if os.path.isdir(entry_path):
+                        shutil.rmtree(entry_path)
+                    else:
+                        os.remove(entry_path)
+                except OSError:
+                    pass
+
+    def _update_stats(self, is_hit: bool) -> None:
+        '''Bump the hit/miss counters, and the persistent ones if is_stats_persisted.'''
+
+        import tempfile
+
+        stats = self._stats
+        stats_path = os.path.join(self._path, 'stats.json')
+        if self._is_stats_persisted:
+            try:
+                with open(stats_path) as stats_file:
+                    stats = json.load(stats_file)
+            except (OSError, ValueError):
+                stats = {}
+
+        self._stats = {'hits': stats.get('hits', 0) + int(is_hit), 'misses': stats.get('misses', 0) + int(not is_hit)}
+        if not self._is_stats_persisted:
+            return
+
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            # Replaced whole so concurrent shells never read a partial file, at worst losing a count
+            stats_fd, stats_tmp_path = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+            with os.fdopen(stats_fd, 'w') as stats_file:
+                json.dump(self._stats, stats_file)
+            os.replace(stats_tmp_path, stats_path)
+        except OSError:
+            pass
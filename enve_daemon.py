@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+import os
+import json
+import array
+import signal
+import socket
+import hashlib
+import enve_cache
+
+ENVE_DAEMON_PATH = os.path.join(enve_cache.ENVE_CACHE_PATH, 'daemon')
+
+# The client's stdin, stdout and stderr are passed along with the request
+ENVE_DAEMON_FDS = (0, 1, 2)
+
+# The signals the client relays to the command while it runs
+ENVE_DAEMON_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT)
+
+def get_socket_path(key: str) -> str:
+    '''The socket of the daemon serving key, e.g. a config and flatpak installation. The name is hashed to stay well
+    within the socket path length limit.'''
+
+    return os.path.join(ENVE_DAEMON_PATH, hashlib.sha256(key.encode()).hexdigest()[:16] + '.sock')
+
+def start_process_group() -> None:
+    '''Make the calling process lead its own process group, with the relayed signals at their default action. Used as
+    the preexec_fn of the commands, since a daemon started in the background would have them ignore SIGINT.'''
+
+    os.setpgrp()
+    for signum in ENVE_DAEMON_SIGNALS:
+        signal.signal(signum, signal.SIG_DFL)
+
+def _recv_message(connection: socket.socket, data: bytes=b'') -> [bytes, bytes]:
+    '''Receive until a newline terminated message is read, returning it without the newline along with anything
+    received after it.'''
+
+    while b'\n' not in data:
+        chunk = connection.recv(65536)
+        if not chunk:
+            raise ConnectionError('Connection closed mid message')
+        data += chunk
+
+    message, _, data = data.partition(b'\n')
+    return message, data
+
+def request(socket_path: str, cmd: list, cwd: str, environ: dict) -> int:
+    '''Run cmd through the daemon listening on socket_path with this process's stdin, stdout and stderr. SIGINT,
+    SIGTERM, SIGHUP and SIGQUIT received while the command runs are relayed to it. Returns the exit status of the
+    command, 128 plus the signal number if it was killed by a signal, or None if no daemon is serving or it refused the
+    request. Raises ConnectionError if the connection is lost once the request was sent, as the command may already
+    have run.'''
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+        connection.sendmsg([json.dumps({'cmd': cmd, 'cwd': cwd, 'environ': dict(environ)}).encode() + b'\n'],
+                           [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', ENVE_DAEMON_FDS))])
+    except OSError:
+        connection.close()
+        return None
+
+    old_handlers = {}
+    try:
+        def relay_signal(signum, frame) -> None:
+            try:
+                connection.sendall(json.dumps({'signal': signum}).encode() + b'\n')
+            except OSError:
+                pass
+
+        for signum in ENVE_DAEMON_SIGNALS:
+            old_handlers[signum] = signal.signal(signum, relay_signal)
+
+        returncode = json.loads(_recv_message(connection)[0])['returncode']
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        raise ConnectionError(str(err)) from err
+    finally:
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
+        connection.close()
+
+    # A command killed by a signal has a negative return code, which isn't a valid exit status
+    return returncode if returncode is None or returncode >= 0 else 128 - returncode
+
+class EnveDaemon:
+    '''Serve requests on a Unix socket, one thread per connection. handle_request is called with the request dict
+    (cmd, cwd and environ) and the client's stdin, stdout and stderr fds, and returns the started subprocess.Popen, or
+    None if the request can't be served. The process should lead its own process group, which is sent the signals the
+    client relays until the process exits. The fds are closed once the request is handled.'''
+
+    def __init__(self, socket_path: str, handle_request):
+        self._socket_path = socket_path
+        self._handle_request = handle_request
+
+    def serve_forever(self, on_listen=None) -> None:
+        '''Serve until interrupted, calling on_listen once the socket is accepting connections.'''
+
+        import threading
+
+        os.makedirs(os.path.dirname(self._socket_path), mode=0o700, exist_ok=True)
+
+        # A socket left behind by a daemon that didn't shut down cleanly refuses connections, and is replaced
+        if os.path.exists(self._socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self._socket_path)
+                raise FileExistsError('ENVE daemon already serving on "%s"' % self._socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self._socket_path)
+            finally:
+                probe.close()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # The socket is created owner only, rather than chmod'ed after bind, so it is never connectable by others
+            old_umask = os.umask(0o177)
+            try:
+                listener.bind(self._socket_path)
+            finally:
+                os.umask(old_umask)
+            listener.listen()
+            if on_listen:
+                on_listen()
+            while True:
+                connection, _ = listener.accept()
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+        finally:
+            listener.close()
+            try:
+                os.remove(self._socket_path)
+            except OSError:
+                pass
+
+    def _serve_connection(self, connection: socket.socket) -> None:
+        import threading
+
+        fds = array.array('i')
+        process = None
+        try:
+            data, ancdata, _, _ = connection.recvmsg(65536, socket.CMSG_SPACE(len(ENVE_DAEMON_FDS) * fds.itemsize))
+            for cmsg_level, cmsg_type, cmsg_data in ancdata:
+                if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+            # Anything after the request is the start of the relayed signals
+            request_line, data = _recv_message(connection, data)
+            request = json.loads(request_line)
+            if request['cmd'] and len(fds) == len(ENVE_DAEMON_FDS):
+                process = self._handle_request(request, list(fds))
+            returncode = None
+            if process is not None:
+                threading.Thread(target=self._relay_signals, args=(connection, data, process), daemon=True).start()
+                returncode = process.wait()
+            connection.sendall(json.dumps({'returncode': returncode}).encode() + b'\n')
+        except (OSError, ValueError, KeyError):
+            # A request refused before its command started is answered, so the client can load the config itself
+            if process is None:
+                try:
+                    connection.sendall(json.dumps({'returncode': None}).encode() + b'\n')
+                except OSError:
+                    pass
+        finally:
+            for fd in fds:
+                os.close(fd)
+            try:
+                # Wakes up the signal relay waiting on the connection
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def _relay_signals(self, connection: socket.socket, data: bytes, process) -> None:
+        '''Send the signals the client relays to the process group of the command, until the connection is shut down.'''
+
+        try:
+            while True:
+                message, data = _recv_message(connection, data)
+                signum = json.loads(message)['signal']
+                if signum in ENVE_DAEMON_SIGNALS and process.poll() is None:
+                    os.killpg(process.pid, signum)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
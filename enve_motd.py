@@ -1,43 +1,168 @@
 #!/usr/bin/python3
 
 import os
+import sys
+import time
 import subprocess
 import pathlib
+import enve_cache
+
+# Seconds the host facts are reused for before they are probed again, overridden by ENVE_MOTD_HOST_TTL
+ENVE_MOTD_HOST_TTL = 300
+
+# One round trip to the host collects every host fact, one "name=value" line each
+ENVE_MOTD_HOST_PROBE = r'''
+echo "root_avail=$(df -B1 --output=avail / | tail -n 1)"
+echo "flatpak_version=$(flatpak --version)"
+'''
+
+def format_si(num_bytes: float) -> str:
+    '''Format a size with SI units the same as "df -H" and "free --si".'''
+
+    for unit in ['B', 'k', 'M', 'G', 'T', 'P']:
+        if num_bytes < 1000 or unit == 'P':
+            break
+        num_bytes /= 1000
+
+    return ('%.1f%s' if num_bytes < 10 and unit != 'B' else '%.0f%s') % (num_bytes, unit)
+
+def get_uptime() -> str:
+    '''The uptime formatted the same as "uptime -p", without the "up".'''
+
+    with open('/proc/uptime') as proc_uptime:
+        minutes = int(float(proc_uptime.read().split()[0])) // 60
+
+    uptime = []
+    for name, unit_minutes in [('week', 7 * 24 * 60), ('day', 24 * 60), ('hour', 60), ('minute', 1)]:
+        count, minutes = divmod(minutes, unit_minutes)
+        if count:
+            uptime.append('%d %s%s' % (count, name, '' if count == 1 else 's'))
+
+    return ', '.join(uptime) or '0 minutes'
+
+def get_processor() -> [str, int]:
+    '''The name of the processor and the number of virtual processors.'''
+
+    processor_name = ''
+    processor_virt_count = 0
+    with open('/proc/cpuinfo') as proc_cpuinfo:
+        for line in proc_cpuinfo:
+            key, _, value = line.partition(':')
+            if key.strip() == 'processor':
+                processor_virt_count += 1
+            elif key.strip() == 'model name' and not processor_name:
+                processor_name = value.strip()
+
+    return processor_name.replace('(R)', '®').replace('(TM)', '™'), processor_virt_count
+
+def get_memory() -> [str, str, str]:
+    '''The used, available and total memory.'''
+
+    meminfo = {}
+    with open('/proc/meminfo') as proc_meminfo:
+        for line in proc_meminfo:
+            key, _, value = line.partition(':')
+            meminfo[key] = int(value.split()[0]) * 1024
+
+    mem_total = meminfo['MemTotal']
+    mem_avail = meminfo.get('MemAvailable', meminfo['MemFree'])
+
+    return format_si(mem_total - mem_avail), format_si(mem_avail), format_si(mem_total)
+
+def get_disk_space(path: str) -> str:
+    '''The space available to unprivileged users on the file system of path.'''
+
+    path_statvfs = os.statvfs(path)
+
+    return format_si(path_statvfs.f_bavail * path_statvfs.f_frsize)
+
+def get_os_release() -> str:
+    '''The pretty name of the flatpak runtime.'''
+
+    for os_release_path in ['/etc/os-release', '/usr/lib/os-release']:
+        try:
+            with open(os_release_path) as os_release:
+                for line in os_release:
+                    if line.startswith('PRETTY_NAME='):
+                        return line.split('=', 1)[1].strip().strip('"\'')
+        except OSError:
+            continue
+
+    return ''
+
+def probe_host() -> dict:
+    '''Collect the host facts with a single host command.'''
+
+    completed_output = subprocess.run(['flatpak-spawn', '--host', 'sh', '-c', ENVE_MOTD_HOST_PROBE],
+                                      capture_output=True, text=True)
+
+    host_facts = {}
+    for line in completed_output.stdout.splitlines():
+        name, _, value = line.partition('=')
+        host_facts[name] = value.strip()
+
+    return host_facts
+
+def refresh_host_facts() -> dict:
+    '''Probe the host and cache the host facts.'''
+
+    host_facts = probe_host()
+    enve_cache.EnveCache('motd').put('host', {'time': time.time(), 'facts': host_facts})
+
+    return host_facts
+
+def get_host_facts() -> dict:
+    '''The cached host facts. When they are older than the TTL, the stale facts are returned right away and refreshed
+    in the background, so the MOTD never waits on the host unless nothing has been cached yet.'''
+
+    try:
+        ttl = float(os.environ.get('ENVE_MOTD_HOST_TTL', ENVE_MOTD_HOST_TTL))
+    except ValueError:
+        ttl = ENVE_MOTD_HOST_TTL
+
+    motd_cache = enve_cache.EnveCache('motd')
+    cache_entry = motd_cache.get('host')
+    if cache_entry is None:
+        return refresh_host_facts()
+
+    # Only one of a burst of new shells starts the refresh, the rest keep using the stale facts meanwhile
+    now = time.time()
+    if now - cache_entry['time'] > ttl and now - cache_entry.get('refresh_time', 0) > ttl:
+        cache_entry['refresh_time'] = now
+        motd_cache.put('host', cache_entry)
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), '--refresh-host'], start_new_session=True,
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return cache_entry['facts']
 
 def enve_motd() -> str:
 
     # get uptime
-    uptime = subprocess.run("uptime -p | cut -d ' ' -f 2-", shell=True, capture_output=True, text=True).stdout.strip()
+    uptime = get_uptime()
 
     # get processors
-    processor_name = subprocess.run("grep 'model name' /proc/cpuinfo | cut -d ' ' -f3- | awk {'print $0'} | head -1",
-                                    shell=True, capture_output=True, text=True).stdout.strip()
-    processor_name = processor_name.replace('(R)', '®')
-    processor_name = processor_name.replace('(TM)', '™')
-    processor_virt_count = subprocess.run("grep -ioP 'processor\t:' /proc/cpuinfo | wc -l",
-                                          shell=True, capture_output=True, text=True).stdout.strip()
+    processor_name, processor_virt_count = get_processor()
 
     # get memory
-    mem_used, mem_avail, mem_total = subprocess.run("free -htg --si | grep 'Mem' | awk {'print $3,$7,$2'}",
-                                                    shell=True, capture_output=True, text=True).stdout.strip().split()
+    mem_used, mem_avail, mem_total = get_memory()
+
+    # get the host facts
+    host_facts = get_host_facts()
 
-    # get disk space
-    disk_space = [('/', subprocess.run("flatpak-spawn --host df -H --output=avail / | tail -n+2",
-                                       shell=True, capture_output=True, text=True).stdout.strip())]
+    # get disk space, the root file system is the host's so it has to be checked on the host
+    root_avail = host_facts.get('root_avail', '')
+    disk_space = [('/', format_si(int(root_avail)) if root_avail.isdigit() else '')]
 
     home_dir = str(pathlib.Path.home())
     if os.path.exists(home_dir):
-        disk_space.append(('~', subprocess.run("flatpak-spawn --host df -H --output=avail %s | tail -n+2" % home_dir,
-                                               shell=True, capture_output=True, text=True).stdout.strip()))
+        disk_space.append(('~', get_disk_space(home_dir)))
 
     while len(disk_space) < 3:
         disk_space.append(('', ''))
 
     # get flatpak
-    flatpak_ver = subprocess.run("flatpak-spawn --host flatpak --version | cut -d ' ' -f 2-",
-                                 shell=True, capture_output=True, text=True).stdout.strip()
-    flatpak_runtime = subprocess.run("cat /etc/*release | grep 'PRETTY_NAME' | cut -d '=' -f 2- | sed 's/\"//g'",
-                                     shell=True, capture_output=True, text=True).stdout.strip()
+    flatpak_ver = host_facts.get('flatpak_version', '').partition(' ')[2]
+    flatpak_runtime = get_os_release()
 
     enve_motd_banner = \
 r"""                 ,,))))))));,
@@ -73,7 +198,12 @@ r"""                 ,,))))))));,
     return enve_motd_banner + enve_motd_stats
 
 def print_enve_motd() -> None:
-    subprocess.run('echo -e "$ENVE_MOTD"', shell=True, env={'ENVE_MOTD': enve_motd()})
+    # The banner colors are written as "\\e" escapes, as interpreted by "echo -e"
+    sys.stdout.write(enve_motd().replace('\\e', '\x1b') + '\n')
+    sys.stdout.flush()
 
 if __name__ == '__main__':
-    print_enve_motd()
+    if sys.argv[1:] == ['--refresh-host']:
+        refresh_host_facts()
+    else:
+        print_enve_motd()
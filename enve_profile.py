@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+
+# Identifies the ENVE processes writing to the same trace, passed on to the spawned ENVE processes
+ENVE_PROFILE_SESSION_VAR = 'ENVE_PROFILE_SESSION'
+
+_profile = None
+
+def _open_lock(profile_path: str):
+    '''Open and lock the file serializing the ENVE processes writing the trace at profile_path. It also holds the
+    session and the last trace id handed out in it. The lock is released when the file is closed.'''
+
+    import fcntl
+
+    lock_file = open(profile_path + '.lock', 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    except OSError:
+        lock_file.close()
+        raise
+    lock_file.seek(0)
+    return lock_file
+
+def _next_trace_id(profile_path: str, session: str) -> int:
+    '''Hand out the next trace id of the session. Each flatpak sandbox has its own pid namespace, so the pids of the
+    ENVE processes can't tell them apart in the trace.'''
+
+    try:
+        with _open_lock(profile_path) as lock_file:
+            lock_session, _, trace_id = lock_file.read().partition('\n')
+            trace_id = int(trace_id) + 1 if lock_session == session and trace_id.isdigit() else 1
+            lock_file.truncate(0)
+            lock_file.write('%s\n%d' % (session, trace_id))
+    except OSError:
+        trace_id = os.getpid()
+
+    return trace_id
+
+def _now() -> int:
+    '''Trace timestamps are wall clock microseconds, so the spans of the spawned ENVE processes line up.'''
+
+    return time.time_ns() // 1000
+
+class _Span:
+    '''Records a complete trace event for the duration of the with block.'''
+
+    def __init__(self, name: str, args: dict):
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = _now()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        _profile['events'].append({'name': self._name, 'cat': 'enve', 'ph': 'X', 'ts': self._start,
+                                   'dur': _now() - self._start, 'pid': _profile['pid'], 'tid': 1,
+                                   'args': self._args})
+        return False
+
+class _NoSpan:
+    '''Used when profiling is off, so spans cost next to nothing.'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name: str, **args):
+    '''Context manager recording the with block as a span named name, with args shown in the trace viewer.'''
+
+    return _NO_SPAN if _profile is None else _Span(name, args)
+
+def start(profile_path: str, process_name: str) -> None:
+    '''Start recording spans, which are written to profile_path in the Chrome trace event format when the process
+    exits. Spawned ENVE processes profiling to the same path add their spans to the same trace.'''
+
+    import atexit
+
+    global _profile
+    session = os.environ.get(ENVE_PROFILE_SESSION_VAR, '%d-%d' % (os.getpid(), time.time_ns()))
+    _profile = {'path': profile_path,
+                'session': session,
+                # Parallel ENVE processes, such as the configs of a matrix, have to be told apart in the trace
+                'pid': _next_trace_id(profile_path, session),
+                'process_name': process_name,
+                'start': _now(),
+                'events': [],
+                'is_written': False}
+    atexit.register(write)
+
+def get_environ() -> dict:
+    '''The environment a spawned ENVE process needs to add its spans to this trace.'''
+
+    return {} if _profile is None else {ENVE_PROFILE_SESSION_VAR: _profile['session']}
+
+def _write_trace() -> None:
+    '''Add the recorded spans to the trace of the session at the profile path, replacing a trace of another session.'''
+
+    import tempfile
+
+    try:
+        with open(_profile['path']) as profile_file:
+            trace = json.load(profile_file)
+        if trace.get('otherData', {}).get('session') != _profile['session']:
+            trace = None
+    except (OSError, ValueError):
+        trace = None
+
+    if trace is None:
+        trace = {'traceEvents': [], 'displayTimeUnit': 'ms', 'otherData': {'session': _profile['session']}}
+
+    trace['traceEvents'] += [
+        {'name': 'process_name', 'ph': 'M', 'pid': _profile['pid'], 'args': {'name': _profile['process_name']}},
+        {'name': 'enve', 'cat': 'enve', 'ph': 'X', 'ts': _profile['start'], 'dur': _now() - _profile['start'],
+         'pid': _profile['pid'], 'tid': 1, 'args': {}}] + _profile['events']
+
+    try:
+        profile_fd, profile_tmp_path = tempfile.mkstemp(dir=os.path.dirname(_profile['path']) or '.', suffix='.tmp')
+        with os.fdopen(profile_fd, 'w') as profile_file:
+            json.dump(trace, profile_file)
+        os.replace(profile_tmp_path, _profile['path'])
+    except OSError:
+        pass
+
+def write() -> None:
+    '''Write the recorded spans, adding them to the trace already written by the other ENVE processes of this session.
+    The processes write one at a time, as ones exiting together would otherwise replace each other's spans. Only the
+    first call writes, so writing before an exec that fails doesn't add the spans again at exit.'''
+
+    if _profile is None or _profile['is_written']:
+        return
+    _profile['is_written'] = True
+
+    try:
+        lock_file = _open_lock(_profile['path'])
+    except OSError:
+        _write_trace()
+        return
+
+    with lock_file:
+        _write_trace()
@@ -8,6 +8,7 @@
 
 from select import select
 import os
+import selectors
 import sys
 import tty
 import signal
@@ -15,8 +16,10 @@ import struct
 import fcntl
 import termios
 import time
+import stat
+import errno
 
-__all__ = ["openpty","fork","spawn","wspawn"]
+__all__ = ["openpty","fork","spawn","wspawn","aspawn","PtyProcess"]
 
 STDIN_FILENO = 0
 STDOUT_FILENO = 1
@@ -24,6 +27,11 @@ STDERR_FILENO = 2
 
 CHILD = 0
 
+# Size of the relay read buffers, and how much unwritten output is buffered
+# before the relay stops reading from its source.
+BUFSIZE = 65536
+HIGH_WATER = 4 * BUFSIZE
+
 def openpty():
     """openpty() -> (master_fd, slave_fd)
     Open a pty master/slave pair, using os.openpty() if possible."""
@@ -123,14 +131,19 @@ def fork():
     return pid, master_fd
 
 def _writen(fd, data):
-    """Write all the data to a descriptor."""
-    while data:
-        n = os.write(fd, data)
-        data = data[n:]
+    """Write all the data to a descriptor, waiting for the descriptor to
+    become writable if it is non-blocking."""
+    with memoryview(data) as view:
+        offset = 0
+        while offset < len(view):
+            try:
+                offset += os.write(fd, view[offset:])
+            except BlockingIOError:
+                select([], [fd], [])
 
 def _read(fd):
     """Default read function."""
-    return os.read(fd, 1024)
+    return os.read(fd, BUFSIZE)
 
 def _copy(master_fd, master_read=_read, stdin_read=_read):
     """Parent copy loop.
@@ -145,7 +158,7 @@ def _copy(master_fd, master_read=_read, stdin_read=_read):
             if not data:  # Reached EOF.
                 fds.remove(master_fd)
             else:
-                os.write(STDOUT_FILENO, data)
+                _writen(STDOUT_FILENO, data)
         if STDIN_FILENO in rfds:
             data = stdin_read(STDIN_FILENO)
             if not data:
@@ -239,8 +252,225 @@ def _ekill(child_pid):
     except:
         pass
 
+def _wsignals():
+    """Route SIGWINCH and SIGCHLD to a self-pipe, returning (read_fd, restore)
+    where restore undoes the signal setup. Returns (None, None) if signals
+    can't be routed, e.g. when not called from the main thread."""
+    rfd, wfd = os.pipe()
+    for fd in (rfd, wfd):
+        os.set_blocking(fd, False)
+        os.set_inheritable(fd, False)
+    try:
+        old_wakeup_fd = signal.set_wakeup_fd(wfd)
+    except ValueError:
+        os.close(rfd)
+        os.close(wfd)
+        return None, None
+
+    # The wakeup fd is only written for signals with a Python handler.
+    old_handlers = {}
+    for signum in (SIGWINCH, signal.SIGCHLD):
+        old_handlers[signum] = signal.signal(signum, lambda signum, frame: None)
+
+    def restore():
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
+        signal.set_wakeup_fd(old_wakeup_fd)
+        os.close(rfd)
+        os.close(wfd)
+    return rfd, restore
+
+def _pidfd(child_pid):
+    """Open a pidfd that becomes readable when the child exits, or return
+    None where pidfds aren't supported."""
+    try:
+        return os.pidfd_open(child_pid)
+    except (AttributeError, OSError):
+        return None
+
+class _Channel:
+    """One direction of the wspawn relay. Data read from src_fd is written
+    straight to dst_fd; whatever dst_fd doesn't accept is buffered, and the
+    channel stops reading once HIGH_WATER bytes are buffered.
+    With the default read function, reads go into a reusable buffer, and
+    splice() moves the data in the kernel where the destination is a pipe
+    and the kernel supports splicing from the source."""
+
+    def __init__(self, src_fd, dst_fd, read):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.read = read
+        self.is_eof = False
+        self._pending = bytearray()
+        self._offset = 0
+        self._buffer = bytearray(BUFSIZE) if read is _read else None
+        self._is_splice = read is _read and hasattr(os, 'splice') and \
+            stat.S_ISFIFO(os.fstat(dst_fd).st_mode)
+
+    def pending(self):
+        return len(self._pending) - self._offset
+
+    def wants_read(self):
+        return not self.is_eof and self.pending() < HIGH_WATER
+
+    def wants_write(self):
+        return self.pending() > 0
+
+    def on_readable(self):
+        if self._is_splice and not self.pending():
+            try:
+                if os.splice(self.src_fd, self.dst_fd, BUFSIZE,
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) == 0:
+                    self.is_eof = True
+                return
+            except BlockingIOError:
+                # Both ends are non-blocking, so this is either the source
+                # having nothing to read or the destination pipe being full.
+                # Reading tells them apart: a read that would block returns,
+                # and data that was read is buffered until dst_fd drains.
+                pass
+            except OSError as e:
+                if e.errno == errno.EIO:
+                    self.is_eof = True
+                    return
+                # Splicing isn't supported for the source, use read/write.
+                self._is_splice = False
+
+        try:
+            if self._buffer is not None:
+                n = os.readv(self.src_fd, [self._buffer])
+                data = memoryview(self._buffer)[:n]
+            else:
+                data = memoryview(self.read(self.src_fd))
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # Linux reports EIO on the master once the slave is closed.
+            if e.errno != errno.EIO:
+                raise
+            data = memoryview(b'')
+
+        with data:
+            if not data:
+                self.is_eof = True
+            elif self.pending():
+                self._pending += data
+            else:
+                n = self._write(data)
+                if n < len(data):
+                    self._pending += data[n:]
+
+    def on_writable(self):
+        if not self.pending():
+            return
+        with memoryview(self._pending) as view:
+            with view[self._offset:] as data:
+                self._offset += self._write(data)
+        if self._offset == len(self._pending):
+            self._pending.clear()
+            self._offset = 0
+        elif self._offset >= HIGH_WATER:
+            del self._pending[:self._offset]
+            self._offset = 0
+
+    def flush(self):
+        """Write out everything buffered, waiting for dst_fd as needed."""
+        while self.pending():
+            self.on_writable()
+            if self.pending():
+                select([], [self.dst_fd], [])
+
+    def _write(self, data):
+        try:
+            return os.write(self.dst_fd, data)
+        except BlockingIOError:
+            return 0
+
 def _wcopy(master_fd, slave_fd, child_pid, master_read=_read, stdin_read=_read, timeout=0.01):
-    """Parent copy loop for wspawn."""
+    """Parent copy loop for wspawn.
+    The loop sleeps until there is data to copy, the window is resized
+    (SIGWINCH) or the child exits (pidfd or SIGCHLD). Once the child has
+    exited, output is drained until none arrives within timeout.
+    Both directions apply backpressure: a channel stops reading while its
+    destination can't keep up."""
+    sig_fd, restore = _wsignals()
+    if sig_fd is None:
+        return _wcopy_poll(master_fd, slave_fd, child_pid, master_read, stdin_read, timeout)
+    pid_fd = _pidfd(child_pid)
+    sel = selectors.DefaultSelector()
+    # Writes to the master must not block when the child isn't reading, and
+    # writes to stdout must not block while it can't keep up, or the relay
+    # couldn't stop reading from the master (backpressure). Stdout is shared
+    # with the caller, so its mode is restored afterwards.
+    os.set_blocking(master_fd, False)
+    stdout_blocking = os.get_blocking(STDOUT_FILENO)
+    os.set_blocking(STDOUT_FILENO, False)
+    out_channel = _Channel(master_fd, STDOUT_FILENO, master_read)
+    in_channel = _Channel(STDIN_FILENO, master_fd, stdin_read)
+    try:
+        sel.register(sig_fd, selectors.EVENT_READ)
+        if pid_fd is not None:
+            sel.register(pid_fd, selectors.EVENT_READ)
+
+        # The child may have exited before the signals were routed.
+        ret = os.waitpid(child_pid, os.WNOHANG)
+        while True:
+            _wregister(sel, master_fd, out_channel.wants_read(), in_channel.wants_write())
+            _wregister(sel, STDIN_FILENO, in_channel.wants_read(), False)
+            _wregister(sel, STDOUT_FILENO, False, out_channel.wants_write())
+            events = sel.select(None if ret == (0,0) else timeout)
+            if ret != (0,0) and not events:
+                break
+            for key, mask in events:
+                if key.fd == sig_fd:
+                    try:
+                        signums = os.read(sig_fd, 1024)
+                    except BlockingIOError:
+                        signums = b''
+                    if SIGWINCH in signums:
+                        _winresz(slave_fd)
+                    if signal.SIGCHLD in signums and ret == (0,0):
+                        ret = os.waitpid(child_pid, os.WNOHANG)
+                elif key.fd == pid_fd:
+                    # The pidfd stays readable, so stop watching it.
+                    sel.unregister(pid_fd)
+                    ret = os.waitpid(child_pid, os.WNOHANG)
+                else:
+                    if key.fd == master_fd and mask & selectors.EVENT_READ:
+                        out_channel.on_readable()
+                    if key.fd == master_fd and mask & selectors.EVENT_WRITE:
+                        in_channel.on_writable()
+                    if key.fd == STDIN_FILENO:
+                        in_channel.on_readable()
+                    if key.fd == STDOUT_FILENO:
+                        out_channel.on_writable()
+        out_channel.flush()
+    finally:
+        sel.close()
+        if pid_fd is not None:
+            os.close(pid_fd)
+        restore()
+        os.set_blocking(STDOUT_FILENO, stdout_blocking)
+    return ret
+
+def _wregister(sel, fd, is_read, is_write):
+    """Update the events the selector waits on for fd."""
+    events = (selectors.EVENT_READ if is_read else 0) | \
+             (selectors.EVENT_WRITE if is_write else 0)
+    try:
+        key = sel.get_key(fd)
+    except KeyError:
+        if events:
+            sel.register(fd, events)
+        return
+    if not events:
+        sel.unregister(fd)
+    elif key.events != events:
+        sel.modify(fd, events)
+
+def _wcopy_poll(master_fd, slave_fd, child_pid, master_read=_read, stdin_read=_read, timeout=0.01):
+    """Polling parent copy loop for wspawn, used when the signals can't be
+    routed to the copy loop."""
     fds = [master_fd, STDIN_FILENO]
     ret = (0,0)
     while True:
@@ -255,7 +485,7 @@ def _wcopy(master_fd, slave_fd, child_pid, master_read=_read, stdin_read=_read,
             if not data:  # Reached EOF.
                 fds.remove(master_fd)
             else:
-                os.write(STDOUT_FILENO, data)
+                _writen(STDOUT_FILENO, data)
         if STDIN_FILENO in rfds:
             data = stdin_read(STDIN_FILENO)
             if not data:
@@ -294,3 +524,179 @@ def wspawn(argv, master_read=_read, stdin_read=_read, timeout=0.01):
 
     _cleanup(master_fd, slave_fd, mode)
     return ret
+
+def _ptyreader(reader):
+    """Return a stream protocol feeding reader from a pty master, treating
+    the EIO Linux reports once the slave is closed as EOF."""
+    import asyncio
+
+    class _PtyReaderProtocol(asyncio.StreamReaderProtocol):
+        def connection_lost(self, exc):
+            if isinstance(exc, OSError) and exc.errno == errno.EIO:
+                exc = None
+            super().connection_lost(exc)
+
+    return _PtyReaderProtocol(reader)
+
+class _PtyWriter:
+    """Writes input to a pty master through an asyncio write transport,
+    with the same write(), drain() and close() methods as a StreamWriter.
+    drain() waits while the transport's buffer is above its high-water mark,
+    which the transport signals through pause_writing() and
+    resume_writing() on the protocol."""
+
+    def __init__(self, loop):
+        self.transport = None
+        self._loop = loop
+        self._paused = False
+        self._drain_waiters = []
+        self._closed = loop.create_future()
+
+    # asyncio.Protocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if not self._closed.done():
+            self._closed.set_result(None)
+        self._paused = False
+        self._wake_drain_waiters(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_drain_waiters(None)
+
+    def _wake_drain_waiters(self, exc):
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                if exc is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(exc)
+        self._drain_waiters.clear()
+
+    # StreamWriter methods
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    def can_write_eof(self):
+        return False
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self._closed
+
+    async def drain(self):
+        """Wait until the transport's buffer is below its high-water mark.
+        Raises ConnectionResetError once the pty is closed."""
+        import asyncio
+
+        if self.transport.is_closing():
+            if self._closed.done():
+                raise ConnectionResetError('Connection lost')
+            # Let connection_lost() run.
+            await asyncio.sleep(0)
+        if not self._paused:
+            return
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+class PtyProcess:
+    """A child process running on its own pty, driven from asyncio.
+    Output of the child is read from reader (an asyncio.StreamReader) and
+    input is written to writer, which has the write(), drain() and close()
+    methods of an asyncio.StreamWriter. exit_status is a
+    future of the child's return code, negative if killed by a signal.
+    Create instances with aspawn()."""
+
+    def __init__(self, process, master_fd, read_transport, reader, writer, exit_status):
+        self.pid = process.pid
+        self.reader = reader
+        self.writer = writer
+        self.exit_status = exit_status
+        self._process = process
+        self._master_fd = master_fd
+        self._read_transport = read_transport
+
+    def get_winsize(self):
+        """Return the window size of the pty as (rows, cols)."""
+        w = struct.pack('HHHH', 0, 0, 0, 0)
+        rows, cols, _, _ = struct.unpack('HHHH', fcntl.ioctl(self._master_fd, termios.TIOCGWINSZ, w))
+        return rows, cols
+
+    def set_winsize(self, rows, cols):
+        """Resize the pty, which sends SIGWINCH to the child's foreground
+        process group."""
+        fcntl.ioctl(self._master_fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    def send_signal(self, signum):
+        self._process.send_signal(signum)
+
+    def terminate(self):
+        self._process.terminate()
+
+    def kill(self):
+        self._process.kill()
+
+    async def wait(self):
+        """Wait for the child to exit, returning its return code."""
+        return await self.exit_status
+
+    def close(self):
+        """Close the pty. The child sees a hangup if it is still running."""
+        self.writer.close()
+        self._read_transport.close()
+        if self._master_fd is not None:
+            os.close(self._master_fd)
+            self._master_fd = None
+
+async def aspawn(argv, rows=24, cols=80, env=None, cwd=None, limit=BUFSIZE):
+    """Create a spawned process on a new pty, returning a PtyProcess.
+    Unlike spawn and wspawn, the caller's stdin and stdout are left alone,
+    so any number of children can be run concurrently from one event loop."""
+    import asyncio
+
+    if type(argv) == type(''):
+        argv = (argv,)
+    sys.audit('pty.aspawn', argv)
+    loop = asyncio.get_running_loop()
+    master_fd, slave_fd = openpty()
+    try:
+        fcntl.ioctl(slave_fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+        process = await asyncio.create_subprocess_exec(
+            *argv, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, env=env, cwd=cwd, start_new_session=True,
+            # Make the pty slave the controlling terminal of the new session.
+            preexec_fn=lambda: fcntl.ioctl(STDIN_FILENO, termios.TIOCSCTTY, 0))
+    except:
+        os.close(master_fd)
+        raise
+    finally:
+        os.close(slave_fd)
+
+    # The transports each own a duplicate of the master, master_fd is kept for resizing.
+    try:
+        reader = asyncio.StreamReader(limit=limit)
+        read_transport, _ = await loop.connect_read_pipe(lambda: _ptyreader(reader), os.fdopen(os.dup(master_fd), 'rb', 0))
+        _, writer = await loop.connect_write_pipe(lambda: _PtyWriter(loop), os.fdopen(os.dup(master_fd), 'wb', 0))
+    except:
+        os.close(master_fd)
+        process.kill()
+        await process.wait()
+        raise
+
+    return PtyProcess(process, master_fd, read_transport, reader, writer, loop.create_task(process.wait()))